@@ -0,0 +1,55 @@
+"""
+Measure how long a fresh interpreter takes to import the irkit packages and to run trecplot
+--help, and whether matplotlib was imported along the way.
+
+Usage:
+
+``python benchmarks/import_time.py --repeat 5``
+"""
+import argparse
+import subprocess
+import sys
+import time
+
+CASES = [
+    ('python (baseline)', 'pass'),
+    ('import irkit.trec.results', 'import irkit.trec.results'),
+    ('import irkit.plot', 'import irkit.plot'),
+    ('trecplot --help', 'import sys, irkit.plot; sys.argv = ["trecplot", "--help"]; '
+                        'irkit.plot.main()'),
+    ('import matplotlib.pyplot', 'import matplotlib.pyplot'),
+]
+
+# Each case runs in a new interpreter, which reports whether matplotlib was imported.
+SCRIPT = """
+import sys
+try:
+    {}
+except SystemExit:
+    pass
+sys.stderr.write(str('matplotlib' in sys.modules))
+"""
+
+
+def run(code: str):
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-c', SCRIPT.format(code)],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    return time.perf_counter() - start, process.stderr.decode().strip().endswith('True')
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--repeat', type=int, default=5)
+    args = argparser.parse_args()
+
+    for name, code in CASES:
+        timings = []
+        for _ in range(args.repeat):
+            seconds, matplotlib = run(code)
+            timings.append(seconds)
+        print('{:<28}{:>8.3f}s  matplotlib imported: {}'.format(name, min(timings), matplotlib))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+Benchmark the line-by-line and bulk (fast=True) parsers of irkit.trec.run.loads on a synthetic
+run file, reporting lines per second.
+
+Usage:
+
+``python benchmarks/parse_runs.py --topics 1000 --depth 1000``
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+# Benchmark the irkit of this checkout, whether or not a version of it is installed.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import irkit.trec.run
+
+
+def synthetic_run(topics: int, depth: int) -> str:
+    random.seed(0)
+    return '\n'.join('{} Q0 DOC-{} {} {:.6f} bench'.format(topic, random.randrange(10 * depth),
+                                                           rank + 1, 1.0 / (rank + 1))
+                     for topic in range(topics) for rank in range(depth))
+
+
+def best_of(repeat: int, fn) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--topics', type=int, default=200)
+    argparser.add_argument('--depth', type=int, default=1000)
+    argparser.add_argument('--repeat', type=int, default=3)
+    args = argparser.parse_args()
+
+    text = synthetic_run(args.topics, args.depth)
+    lines = args.topics * args.depth
+    assert irkit.trec.run.loads(text).dumps() == irkit.trec.run.loads(text, fast=True).dumps()
+
+    for name, fast in (('line-by-line', False), ('bulk', True)):
+        seconds = best_of(args.repeat, lambda: irkit.trec.run.loads(text, fast=fast))
+        print('{:<14}{:>12,.0f} lines/s ({:.3f}s for {:,} lines)'.format(
+            name, lines / seconds, seconds, lines))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Measure the memory used per row by TrecEvalRun and Qrel objects compared with equivalent classes
+that keep their fields in a per-instance __dict__, and with the columnar TrecEvalRuns storage.
+
+Usage:
+
+``python benchmarks/row_memory.py --rows 1000000``
+"""
+import argparse
+import os
+import sys
+import tracemalloc
+
+# Benchmark the irkit of this checkout, whether or not a version of it is installed.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import irkit.trec.run
+from irkit.trec.qrels import Qrel
+from irkit.trec.run import TrecEvalRun
+
+
+class DictTrecEvalRun(object):
+    def __init__(self, topic, q, doc_id, rank, score, run_id):
+        self.topic = topic
+        self.q = q
+        self.doc_id = doc_id
+        self.rank = rank
+        self.score = score
+        self.run_id = run_id
+
+
+class DictQrel(object):
+    def __init__(self, topic, iteration, document_num, relevancy):
+        self.topic = topic
+        self.iteration = iteration
+        self.document_num = document_num
+        self.relevancy = relevancy
+
+
+def run_fields(topics, docs, scores):
+    return zip(topics, ['0'] * len(topics), docs, range(1, len(topics) + 1), scores,
+               ['run'] * len(topics))
+
+
+def bytes_per_row(rows: int, make) -> float:
+    # The field values are created up front so that only the row objects are measured.
+    topics = [str(i // 1000) for i in range(rows)]
+    docs = ['DOC-{}'.format(i) for i in range(rows)]
+    scores = [1.0 / (i + 1) for i in range(rows)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = make(topics, docs, scores)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return (after - before) / rows
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--rows', type=int, default=200000)
+    args = argparser.parse_args()
+
+    cases = [
+        ('TrecEvalRun (__dict__)',
+         lambda t, d, s: [DictTrecEvalRun(*r) for r in run_fields(t, d, s)]),
+        ('TrecEvalRun (__slots__)',
+         lambda t, d, s: [TrecEvalRun(*r) for r in run_fields(t, d, s)]),
+        ('TrecEvalRuns (columns)',
+         lambda t, d, s: irkit.trec.run.TrecEvalRuns(TrecEvalRun(*r) for r in run_fields(t, d, s))),
+        ('Qrel (__dict__)', lambda t, d, s: [DictQrel(a, 0, b, 1) for a, b in zip(t, d)]),
+        ('Qrel (__slots__)', lambda t, d, s: [Qrel(a, 0, b, 1) for a, b in zip(t, d)]),
+    ]
+    for name, make in cases:
+        print('{:<26}{:>8.1f} bytes/row'.format(name, bytes_per_row(args.rows, make)))
+
+
+if __name__ == '__main__':
+    main()
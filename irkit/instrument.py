@@ -0,0 +1,225 @@
+"""
+Opt-in instrumentation of the entry points of irkit (loading runs, qrels and results, walking
+ElasticSearch queries, evaluating and plotting). While instrumentation is enabled, every call of
+an instrumented function records its wall time, how many rows, queries or nodes it processed and,
+if asked for, its peak memory allocation (with tracemalloc). Records are passed to the registered
+callbacks; profile registers one which collects them into a JSON report.
+
+When nothing is registered an instrumented function only checks a list before calling through,
+so instrumentation costs essentially nothing when it is disabled.
+
+Usage:
+
+>>> from irkit.trec import run
+>>> with profile() as p:
+...     runs = run.loads('1 0 D1 1 2 r\\n1 0 D2 2 1 r')
+>>> [(record.name, record.count, record.unit) for record in p.records]
+[('irkit.trec.run.loads', 2, 'rows')]
+>>> p.summary()['irkit.trec.run.loads']['calls']
+1
+"""
+import functools
+import json
+import time
+import tracemalloc
+
+import io
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List
+
+# The callbacks called with each Record; instrumentation is enabled while there are any.
+_callbacks: List[Callable] = []
+
+# The number of active registrations which asked for memory to be traced, and whether tracing
+# was started by this module.
+_memory = [0, False]
+
+# The instrumented calls in progress, innermost last: the memory traced when each started and
+# the peak seen by the calls it made (None when memory is not traced).
+_stack: List[List[int]] = []
+
+
+class Record(object):
+    """
+    A record of one call of an instrumented function.
+    """
+
+    __slots__ = ('name', 'start', 'seconds', 'count', 'unit', 'peak_bytes', 'depth')
+
+    def __init__(self, name: str, start: float, seconds: float, count: int, unit: str,
+                 peak_bytes: int, depth: int):
+        self.name = name
+        self.start = start
+        self.seconds = seconds
+        self.count = count
+        self.unit = unit
+        self.peak_bytes = peak_bytes
+        self.depth = depth
+
+    def to_dict(self) -> dict:
+        """
+        :return: The record as a dict which can be serialised as JSON.
+        """
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+def register(callback: Callable[[Record], None], memory: bool = False) -> None:
+    """
+    Register a callback to be called with the Record of every instrumented call, enabling
+    instrumentation.
+
+    :param callback: A function taking a Record
+    :param memory: Also trace the peak memory allocated by each call (which slows calls down)
+    """
+    _callbacks.append(callback)
+    if memory:
+        _memory[0] += 1
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _memory[1] = True
+
+
+def unregister(callback: Callable[[Record], None], memory: bool = False) -> None:
+    """
+    Remove a callback added with register, disabling instrumentation if it was the last one.
+
+    :param callback: The callback
+    :param memory: Whether the callback was registered with memory=True
+    """
+    _callbacks.remove(callback)
+    if memory:
+        _memory[0] -= 1
+        if _memory[0] == 0 and _memory[1]:
+            tracemalloc.stop()
+            _memory[1] = False
+
+
+def _call(name: str, function: Callable, args: tuple, kwargs: dict, count: Callable,
+          unit: str):
+    tracing = _memory[0] > 0 and tracemalloc.is_tracing()
+    entry = None
+    if tracing:
+        current, peak = tracemalloc.get_traced_memory()
+        if _stack and _stack[-1] is not None:
+            _stack[-1][1] = max(_stack[-1][1], peak)
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        entry = [current, 0]
+    _stack.append(entry)
+    wall = time.time()
+    start = time.perf_counter()
+    try:
+        result = function(*args, **kwargs)
+    finally:
+        seconds = time.perf_counter() - start
+        _stack.pop()
+        peak_bytes = None
+        if entry is not None:
+            peak = max(tracemalloc.get_traced_memory()[1], entry[1])
+            peak_bytes = peak - entry[0]
+            if _stack and _stack[-1] is not None:
+                _stack[-1][1] = max(_stack[-1][1], peak)
+    record = Record(name, wall, seconds, count(result, *args, **kwargs) if count else None,
+                    unit, peak_bytes, len(_stack))
+    for callback in list(_callbacks):
+        callback(record)
+    return result
+
+
+def rows(result, *args, **kwargs) -> int:
+    """
+    Count the rows of a result (its length).
+    """
+    return len(result)
+
+
+def instrumented(name: str = None, count: Callable = rows, unit: str = 'rows') -> Callable:
+    """
+    Decorate a function so its calls are recorded while instrumentation is enabled.
+
+    :param name: The name of the records (defaults to the module and name of the function)
+    :param count: A function called with the result and the arguments of a call, returning the
+                  number of items processed (or None to not count)
+    :param unit: What count counts, e.g. rows or nodes
+    :return: A decorator
+    """
+
+    def decorator(function: Callable) -> Callable:
+        label = name or '{}.{}'.format(function.__module__, function.__qualname__)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _callbacks:
+                return function(*args, **kwargs)
+            return _call(label, function, args, kwargs, count, unit)
+
+        return wrapper
+
+    return decorator
+
+
+class Profile(object):
+    """
+    A callback collecting the records of instrumented calls.
+    """
+
+    def __init__(self):
+        self.records: List[Record] = []
+
+    def __call__(self, record: Record) -> None:
+        self.records.append(record)
+
+    def summary(self) -> Dict[str, dict]:
+        """
+        Total the records of each function.
+
+        :return: A mapping of name to the number of calls, the total seconds and count, and the
+                 largest peak allocation (None if memory was not traced)
+        """
+        summary = {}
+        for record in self.records:
+            entry = summary.setdefault(record.name, {'calls': 0, 'seconds': 0.0, 'count': 0,
+                                                     'unit': record.unit, 'peak_bytes': None})
+            entry['calls'] += 1
+            entry['seconds'] += record.seconds
+            if record.count is not None:
+                entry['count'] += record.count
+            if record.peak_bytes is not None:
+                entry['peak_bytes'] = max(entry['peak_bytes'] or 0, record.peak_bytes)
+        return summary
+
+    def report(self) -> dict:
+        """
+        :return: The summary and every record, as a dict which can be serialised as JSON.
+        """
+        return {'summary': self.summary(), 'records': [r.to_dict() for r in self.records]}
+
+    def dumps(self) -> str:
+        """
+        :return: The report as JSON
+        """
+        return json.dumps(self.report(), indent=2)
+
+    def dump(self, fp: io.TextIOWrapper) -> None:
+        """
+        Write the report as JSON to a file.
+
+        :param fp: File pointer
+        """
+        json.dump(self.report(), fp, indent=2)
+
+
+@contextmanager
+def profile(memory: bool = False) -> Iterator[Profile]:
+    """
+    Record the instrumented calls made within a with block.
+
+    :param memory: Also trace the peak memory allocated by each call
+    :return: A Profile which collects the records
+    """
+    collector = Profile()
+    register(collector, memory)
+    try:
+        yield collector
+    finally:
+        unregister(collector, memory)
@@ -1,17 +1,36 @@
 import argparse
 
+import os
+
 import irkit.trec.results
-from irkit.plot.trecplot import pr_curve
+from irkit.plot.batch import read_manifest, render
+from irkit.plot.trecplot import figure
 
 
 def main():
     argparser = argparse.ArgumentParser()
 
     argparser.add_argument('--trec_results', help='trec_eval results files.',
-                           required=True, type=argparse.FileType('r'), nargs='+')
-    argparser.add_argument('--output', help='Name of the output file.', type=str,
-                           default='output', required=False)
+                           required=False, type=argparse.FileType('r'), nargs='+')
+    argparser.add_argument('--manifest', help='Manifest of plots to render in parallel (see '
+                                              'irkit.plot.batch).',
+                           type=argparse.FileType('r'), required=False)
+    argparser.add_argument('--output', help='Name of the output file, or the directory of the '
+                                            'outputs of a manifest.', type=str,
+                           default=None, required=False)
+    argparser.add_argument('--processes', help='Number of worker processes for a manifest.',
+                           type=int, default=None, required=False)
 
     args = argparser.parse_args()
-    pr_curve([irkit.trec.results.load(f) for f in args.trec_results]).savefig('output',
-                                                                              bbox_inches='tight')
+    if (args.trec_results is None) == (args.manifest is None):
+        argparser.error('one of --trec_results or --manifest is required')
+
+    if args.manifest is not None:
+        jobs = read_manifest(args.manifest, os.path.dirname(args.manifest.name),
+                             args.output or '.')
+        for path in render(jobs, args.processes):
+            print(path)
+        return
+
+    figure('pr_curve', [irkit.trec.results.load(f) for f in args.trec_results]).savefig(
+        args.output or 'output', bbox_inches='tight')
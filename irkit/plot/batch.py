@@ -0,0 +1,86 @@
+"""
+Render many plots in parallel from a manifest. A manifest has one JSON object per line, naming
+the plot to draw, the trec_eval results files to draw it from, and the file to save it to:
+
+``{"plot": "topic_ap", "results": ["bm25.results", "tfidf.results"], "output": "ap.pdf"}``
+
+``plot`` defaults to pr_curve, and any other keys are passed to the plotting function (e.g.
+``"sort_on_ap": true``). Relative paths of results files are relative to the manifest, and
+relative outputs are relative to the output directory. Each plot is drawn on a Figure of its own
+in a pool of worker processes, which load their own results files and save their own outputs.
+
+Command line usage:
+
+``trecplot --manifest plots.jsonl --output figures/ --processes 8``
+"""
+import json
+import multiprocessing
+
+import io
+import os
+from typing import Dict, Iterable, List
+
+import irkit.trec.results
+from irkit.instrument import instrumented
+
+
+def read_manifest(fp: io.TextIOWrapper, base: str = '.', output: str = '.') -> List[Dict]:
+    """
+    Read the jobs of a manifest, resolving their paths.
+
+    :param fp: A file pointer to a manifest
+    :param base: The directory relative results paths are resolved against
+    :param output: The directory relative output paths are resolved against
+    :return: A dict for each job, with the keys plot, results, output and options
+    """
+    jobs = []
+    for number, line in enumerate(fp, 1):
+        if not line.strip():
+            continue
+        job = json.loads(line)
+        try:
+            paths = job.pop('results')
+            path = job.pop('output')
+        except KeyError as e:
+            raise ValueError('Line {} of the manifest has no {}'.format(number, e))
+        jobs.append({'plot': job.pop('plot', 'pr_curve'),
+                     'results': [os.path.join(base, p) for p in paths],
+                     'output': os.path.join(output, path),
+                     'options': job})
+    return jobs
+
+
+def render_job(job: Dict) -> str:
+    """
+    Load the results of a job, draw its plot and save it.
+
+    :param job: A job, as returned by read_manifest
+    :return: The path of the saved plot
+    """
+    from irkit.plot.trecplot import figure
+    results = []
+    for path in job['results']:
+        with open(path) as fp:
+            results.append(irkit.trec.results.load(fp))
+    directory = os.path.dirname(job['output'])
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    figure(job['plot'], results, **job['options']).savefig(job['output'], bbox_inches='tight')
+    return job['output']
+
+
+@instrumented(unit='plots')
+def render(jobs: Iterable[Dict], processes: int = None) -> List[str]:
+    """
+    Render jobs in a pool of worker processes.
+
+    :param jobs: Jobs, as returned by read_manifest
+    :param processes: Number of worker processes (defaults to the number of CPUs)
+    :return: The paths of the saved plots, in the same order as the jobs
+    """
+    jobs = list(jobs)
+    processes = min(processes or os.cpu_count() or 1, max(len(jobs), 1))
+    if processes == 1:
+        return [render_job(job) for job in jobs]
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(render_job, jobs, chunksize=1)
@@ -1,37 +1,119 @@
 """
 Various plotting functions.
 
+matplotlib is only imported, and its styles applied, when the first plot is drawn, so importing
+this module (and running trecplot --help) stays fast.
+
 Harry Scells
 Mar 2017
 """
 
+import os
 import re
+import sys
 
-import matplotlib as mpl
-import matplotlib.pyplot as plt
 import numpy as np
-from typing import List
+from typing import TYPE_CHECKING, List, Tuple
+
+from irkit.instrument import instrumented
+from irkit.trec.results import TrecEvalResults, aligned
+
+if TYPE_CHECKING:
+    import matplotlib.axes
+    import matplotlib.figure
+
+STYLES = ('grayscale', 'seaborn-poster', 'seaborn-white')
+
+_plt = None
+_configured = False
+
+
+def _headless() -> bool:
+    """
+    Whether there is no display to show interactive figures on.
+    """
+    if sys.platform in ('win32', 'darwin'):
+        return False
+    return not (os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+
+
+def _configure() -> None:
+    """
+    Import matplotlib and apply the styles of the plots, the first time it is called.
+    """
+    global _configured
+    if _configured:
+        return
+    import matplotlib as mpl
+    import matplotlib.style
+
+    # This causes matplotlib to use Type 42 (a.k.a. TrueType) fonts for PostScript and PDF files.
+    # This allows you to avoid Type 3 fonts without limiting yourself to the stone-age technology
+    # of Type 1 fonts.
+    mpl.rcParams['pdf.fonttype'] = 42
+    mpl.rcParams['ps.fonttype'] = 42
+
+    for style in STYLES:
+        try:
+            matplotlib.style.use(style)
+        except OSError:
+            # matplotlib 3.6 renamed the seaborn styles.
+            matplotlib.style.use(style.replace('seaborn-', 'seaborn-v0_8-'))
+    _configured = True
+
+
+def _pyplot():
+    """
+    Import matplotlib.pyplot, the first time it is called. Unless a backend has been chosen
+    already (with MPLBACKEND or by importing pyplot), the non-interactive Agg backend is used when
+    there is no display.
+
+    :return: The matplotlib.pyplot module
+    """
+    global _plt
+    if _plt is not None:
+        return _plt
+    import matplotlib as mpl
+    if 'matplotlib.pyplot' not in sys.modules and 'MPLBACKEND' not in os.environ and _headless():
+        mpl.use('Agg')
+    import matplotlib.pyplot as plt
+    _configure()
+    _plt = plt
+    return plt
 
-from irkit.trec.results import TrecEvalResults
 
-# This causes matplotlib to use Type 42 (a.k.a. TrueType) fonts for PostScript and PDF files.
-# This allows you to avoid Type 3 fonts without limiting yourself to the stone-age technology
-# of Type 1 fonts.
-mpl.rcParams['pdf.fonttype'] = 42
-mpl.rcParams['ps.fonttype'] = 42
+@instrumented(count=lambda figure, plot, results, *args, **kwargs: len(results), unit='runs')
+def figure(plot: str, results: List[TrecEvalResults], **kwargs) -> 'matplotlib.figure.Figure':
+    """
+    Draw a plot on a new Figure of its own, rather than on the global state of pyplot, so that
+    any number of figures can be drawn (in any thread or process) and saved independently.
 
-plt.style.use('grayscale')
-plt.style.use('seaborn-poster')
-plt.style.use('seaborn-white')
+    :param plot: The name of a plotting function of this module, e.g. pr_curve or topic_ap
+    :param results: A list of TrecEvalResults files.
+    :param kwargs: Further arguments of the plotting function
+    :return: A matplotlib Figure
+    """
+    if plot not in PLOTS:
+        raise ValueError('Unknown plot {}'.format(plot))
+    _configure()
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    PLOTS[plot](results, axes=fig.add_subplot(1, 1, 1), **kwargs)
+    return fig
 
 
-def pr_curve(results: List[TrecEvalResults]) -> plt:
+@instrumented(count=lambda results, *args, **kwargs: len(results), unit='runs')
+def pr_curve(results: List[TrecEvalResults], axes: 'matplotlib.axes.Axes' = None):
     """
     Create a precision-recall graph from trec_eval results.
     
     :param results: A list of TrecEvalResults files.
-    :return: a matplotlib plt object
+    :param axes: Axes to draw on, instead of the current axes of pyplot.
+    :return: a matplotlib plt object (or the figure of the axes, if given)
     """
+    ax = axes if axes is not None else _pyplot().gca()
 
     names = [r.run_id for r in results]
     iprec = [[r.results['iprec_at_recall_0.00'],
@@ -48,27 +130,103 @@ def pr_curve(results: List[TrecEvalResults]) -> plt:
 
     recall = np.arange(0, 1.1, 0.1)
 
-    mpl.rc('xtick', labelsize=35)
-    mpl.rc('ytick', labelsize=35)
+    ax.tick_params(labelsize=35)
 
-    plt.xlabel('Recall', fontsize=35)
-    plt.ylabel('Interpolated Precision', fontsize=35)
+    ax.set_xlabel('Recall', fontsize=35)
+    ax.set_ylabel('Interpolated Precision', fontsize=35)
 
     for p in iprec:
-        plt.plot(recall, p, linewidth=10)
+        ax.plot(recall, p, linewidth=10)
+
+    ax.legend(names, fontsize=35)
+    return _pyplot() if axes is None else axes.figure
 
-    plt.legend(names, fontsize=35)
-    return plt
 
+def _topic_values(results: List[TrecEvalResults]) -> Tuple[np.ndarray, np.ndarray, str]:
+    """
+    The topics and average precision of one run, or the difference in average precision of two
+    runs, as arrays.
 
-def topic_ap(results: List[TrecEvalResults], sort_on_ap=False):
+    :return: The topics, the values, and a label for the values
     """
-    Create an average-precision topic visualisation.
+    if len(results) == 2:
+        topics, ap = aligned(results, 'map')
+        assert len(topics) == len(results[0].query_ids) == len(results[1].query_ids), \
+            'Topic set is not the same!'
+        return topics, ap[0] - ap[1], 'Average Precision difference'
+    elif len(results) == 1:
+        return results[0].query_ids, results[0].column('map'), 'Average Precision'
+    else:
+        raise Exception('Can only plot either one or two TrecEvalResults objects.')
+
+
+def _aggregate_topic_ap(ax, results: List[TrecEvalResults], aggregate: str, bins: int,
+                        k: int) -> None:
+    """
+    Draw an aggregated topic_ap plot. The values of the topics are only handled with numpy, so
+    the number of bars drawn (and the time taken to draw them) depends on bins or k, not on the
+    number of topics.
+    """
+    topics, values, label = _topic_values(results)
+    difference = len(results) == 2
+    if aggregate == 'bins':
+        counts, edges = np.histogram(values, bins, range=(-1, 1) if difference else (0, 1))
+        ax.bar(edges[:-1], counts, np.diff(edges), align='edge')
+        ax.set_xlabel(label)
+        ax.set_ylabel('Topics')
+    elif aggregate == 'quantiles':
+        percentiles = np.linspace(0, 100, bins + 1)
+        ax.plot(percentiles, np.percentile(values, percentiles) if len(values) else
+                np.zeros(len(percentiles)), marker='o')
+        ax.set_xlabel('Percentile of topics')
+        ax.set_ylabel(label)
+    elif aggregate == 'extremes':
+        # argpartition finds the k lowest and k highest values in linear time; only those 2k
+        # values are then sorted.
+        n = len(values)
+        if 2 * k < n:
+            bottom = np.argpartition(values, k - 1)[:k] if k else np.array([], dtype=np.int64)
+            top = np.argpartition(values, n - k)[n - k:] if k else np.array([], dtype=np.int64)
+            chosen = np.concatenate([top, bottom])
+        else:
+            chosen = np.arange(n)
+        chosen = chosen[np.argsort(-values[chosen], kind='stable')]
+        ind = np.arange(len(chosen))
+        ax.bar(ind, values[chosen], 1.0)
+        ax.set_xticks(ind)
+        ax.set_xticklabels(topics[chosen], fontsize=10, rotation='vertical')
+        ax.set_ylabel(label)
+        ax.set_xlabel('Topic (top and bottom {})'.format(k))
+    else:
+        raise ValueError('Unknown aggregate {}'.format(aggregate))
+
+
+@instrumented(count=lambda results, *args, **kwargs: len(results), unit='runs')
+def topic_ap(results: List[TrecEvalResults], sort_on_ap=False,
+             axes: 'matplotlib.axes.Axes' = None, aggregate: str = None, bins: int = 20,
+             k: int = 20):
+    """
+    Create an average-precision topic visualisation. By default there is one bar per topic,
+    which is unreadable (and slow to draw) for thousands of topics; the aggregated modes draw:
+
+    - ``bins``: a histogram of the number of topics in each of ``bins`` bins of average precision
+      (or of the difference, for two runs)
+    - ``quantiles``: the average precision at ``bins`` + 1 evenly spaced percentiles of the topics
+    - ``extremes``: one bar for each of the ``k`` topics with the highest and the ``k`` with the
+      lowest average precision (or difference)
     
     :param results: A list of TrecEvalResults files.
     :param sort_on_ap: Should the visualisation be sorted using average precision?
-    :return: a matplotlib plt object.
+    :param axes: Axes to draw on, instead of the current axes of pyplot.
+    :param aggregate: None for a bar per topic, or bins, quantiles or extremes.
+    :param bins: The number of bins or quantiles of the aggregated modes.
+    :param k: The number of topics at each end of the extremes mode.
+    :return: a matplotlib plt object (or the figure of the axes, if given).
     """
+    if aggregate is not None:
+        ax = axes if axes is not None else _pyplot().gca()
+        _aggregate_topic_ap(ax, results, aggregate, bins, k)
+        return _pyplot() if axes is None else axes.figure
 
     def natural_sort(l):
         """
@@ -96,18 +254,20 @@ def topic_ap(results: List[TrecEvalResults], sort_on_ap=False):
         :param sort_on_ap:
         :return:
         """
+        ax = axes if axes is not None else _pyplot().gca()
         if sort_on_ap:
             topic_names = [n for (d, n) in sorted(zip(ap, topic_names), reverse=True)]
             ap = sorted(ap, reverse=True)
 
         ind = np.arange(len(topic_names))
         width = 1.0
-        plt.bar(ind, ap, width)
-        plt.xticks(ind + 0.5 * width, topic_names, fontsize=10, rotation='vertical')
-        plt.ylabel(ylabel)
-        plt.xlabel('Topic')
+        ax.bar(ind, ap, width)
+        ax.set_xticks(ind + 0.5 * width)
+        ax.set_xticklabels(topic_names, fontsize=10, rotation='vertical')
+        ax.set_ylabel(ylabel)
+        ax.set_xlabel('Topic')
 
-        return plt
+        return _pyplot() if axes is None else axes.figure
 
     if len(results) == 2:
         r1 = results[0]
@@ -133,3 +293,10 @@ def topic_ap(results: List[TrecEvalResults], sort_on_ap=False):
         return plot(ap, ylabel, topic_names, sort_on_ap)
     else:
         raise Exception('Can only plot either one or two TrecEvalResults objects.')
+
+
+# The plots which can be drawn by figure (and listed in a batch manifest).
+PLOTS = {
+    'pr_curve': pr_curve,
+    'topic_ap': topic_ap,
+}
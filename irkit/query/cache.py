@@ -0,0 +1,204 @@
+"""
+A memoizing cache for walking ElasticSearch queries. Query logs are full of repeated queries and
+repeated subtrees, so the work of walking them can be reused. Queries are identified by a
+structural hash (of their JSON serialisation, which keeps key order since key order determines
+the order of visits), and visitors by their Visitor.cache_key.
+
+- traverse caches, for a whole query, the nodes the visitor matched. A repeated query is not
+  walked again: the visitor is called with the cached nodes, in the same order.
+- transform caches the output of whole queries and of every node the visitor matched. A repeated
+  query, or a repeated node anywhere in a new query, is replaced by the cached output instead of
+  being walked and visited again.
+
+Entries are evicted least recently used first. Queries must be JSON serialisable; anything else
+is walked without the cache.
+
+Usage:
+
+>>> from irkit.query.elasticsearch import Visitor, transform
+>>> class ExampleVisitor(Visitor):
+...     def visit(self, node: dict):
+...         node['must_not'] = node.pop(self.node_name)
+>>> cache = QueryCache(maxsize=100)
+>>> transform({'bool': {'must': {'match': 'a'}}}, ExampleVisitor('must'), cache)
+{'bool': {'must_not': {'match': 'a'}}}
+>>> cache.hits, cache.misses
+(0, 2)
+>>> transform({'bool': {'must': {'match': 'a'}}}, ExampleVisitor('must'), cache)
+{'bool': {'must_not': {'match': 'a'}}}
+>>> cache.hits, cache.misses
+(1, 2)
+>>> transform({'filter': [{'bool': {'must': {'match': 'a'}}}]}, ExampleVisitor('must'), cache)
+{'filter': [{'bool': {'must_not': {'match': 'a'}}}]}
+>>> cache.hits, cache.misses
+(2, 3)
+"""
+import hashlib
+import json
+from collections import OrderedDict
+
+from typing import Generic, Hashable, List
+
+from irkit.query.elasticsearch import Visitor, Walker
+
+_TRAVERSE = 0
+_TRANSFORM = 1
+_NODE = 2
+
+
+def structural_hash(query) -> bytes:
+    """
+    Hash the structure and values of a query (or a subtree of one).
+
+    :param query: An ElasticSearch query or part of one
+    :return: A digest which is equal for structurally equal queries
+    """
+    text = json.dumps(query, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha1(text.encode('utf-8')).digest()
+
+
+class _Recorder(Visitor):
+    """
+    Records the nodes a visitor would be called with.
+    """
+
+    def __init__(self, node_name: str):
+        super().__init__(node_name)
+        self.result = []
+
+    def visit(self, node: dict):
+        self.result.append(node)
+
+
+class _CachingWalker(Walker):
+    """
+    A Walker which looks up the transformed output of each matching node in the cache.
+    """
+
+    def __init__(self, visitors: List[Visitor], cache: 'QueryCache'):
+        super().__init__(visitors)
+        self.cache = cache
+
+    def _visit_transform(self, node: dict, visitors: List[Visitor]):
+        key = (_NODE, structural_hash(node), tuple(v.cache_key() for v in visitors))
+        entry = self.cache.get(key)
+        if entry is not None:
+            output, value = entry
+            node.clear()
+            node.update(json.loads(output))
+            return value
+        value = super()._visit_transform(node, visitors)
+        self.cache.put(key, (json.dumps(node), value))
+        return value
+
+
+class QueryCache(object):
+    """
+    An LRU cache of the results of traversing and transforming ElasticSearch queries, with hit
+    and miss counters.
+    """
+
+    def __init__(self, maxsize: int = 65536):
+        """
+        :param maxsize: The maximum number of entries to keep
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Hashable):
+        """
+        Look up an entry, counting a hit or a miss.
+
+        :param key: The key of the entry
+        :return: The entry, or None
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: Hashable, entry) -> None:
+        """
+        Add an entry, evicting the least recently used entries if the cache is full.
+
+        :param key: The key of the entry
+        :param entry: The value to store
+        """
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """
+        Remove every entry and reset the counters.
+        """
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def traverse(self, query: dict, visitor: Visitor) -> Generic:
+        """
+        Traverse a query as irkit.query.elasticsearch.traverse does, without walking queries
+        which have been traversed before by an equivalent visitor. The visitor is still called
+        with every matching node, which for a cached query is a copy of the node.
+
+        :param query: An ElasticSearch query.
+        :param visitor: An implemented Visitor class.
+        :return: The value stored in visitor.result.
+        """
+        try:
+            key = (_TRAVERSE, structural_hash(query), visitor.cache_key())
+        except TypeError:
+            return Walker([visitor]).traverse(query)[0]
+        nodes = self.get(key)
+        if nodes is None:
+            nodes = Walker([_Recorder(visitor.node_name)]).traverse(query)[0]
+            self.put(key, [json.loads(json.dumps(node)) for node in nodes])
+        for node in nodes:
+            visitor.visit(node)
+        return visitor.result
+
+    def transform(self, query: dict, visitor: Visitor, in_place: bool = True) -> dict:
+        """
+        Transform a query as irkit.query.elasticsearch.transform does, reusing the output for
+        queries and matching nodes which have been transformed before by an equivalent visitor.
+
+        :param query: An ElasticSearch query.
+        :param visitor: An implemented Visitor class.
+        :param in_place: Modify the query, rather than returning a copy (a cached query is
+                         returned as a new copy, otherwise the copy shares structure).
+        :return: A modified query
+        """
+        try:
+            if not isinstance(query, (dict, list)):
+                raise TypeError('Only dict and list queries are cached')
+            key = (_TRANSFORM, structural_hash(query), visitor.cache_key())
+        except TypeError:
+            return Walker([visitor]).transform(query, in_place)
+        walker = _CachingWalker([visitor], self)
+        if isinstance(query, dict) and visitor.node_name in query:
+            # The visitors' return value is the result when the query itself matches, so only
+            # the matching node is cached.
+            return walker.transform(query, in_place)
+        output = self.get(key)
+        if output is not None:
+            if not in_place:
+                return json.loads(output)
+            if type(query) is list:
+                query[:] = json.loads(output)
+            else:
+                query.clear()
+                query.update(json.loads(output))
+            return query
+        transformed = walker.transform(query, in_place)
+        self.put(key, json.dumps(transformed))
+        return transformed
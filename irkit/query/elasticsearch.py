@@ -6,7 +6,12 @@ Jun 2017
 """
 from collections import OrderedDict
 
-from typing import Generic
+from typing import TYPE_CHECKING, Generic, Iterable, List
+
+from irkit.instrument import instrumented
+
+if TYPE_CHECKING:
+    import irkit.query.cache
 
 
 class Visitor(object):
@@ -32,8 +37,220 @@ class Visitor(object):
         """
         raise NotImplementedError()
 
+    def cache_key(self):
+        """
+        Identify what this visitor does, for caching the results of walking a query with it (see
+        irkit.query.cache). Two visitors with equal keys must visit and transform nodes in the
+        same way. Override this if the behaviour of a visitor depends on more than its class and
+        node name.
+
+        :return: A hashable key
+        """
+        return type(self).__module__, type(self).__qualname__, self.node_name
+
+
+# Actions on the explicit stack of a Walker.
+_DESCEND = 0
+_VISIT = 1
+
+
+class Walker(object):
+    """
+    A compiled walk over ElasticSearch queries for several visitors at once. The visitors are
+    compiled into a table from node name to the visitors of that name, so each node of a query is
+    examined once no matter how many visitors there are, and the query is walked with an explicit
+    stack rather than recursion. Visitors are called in the same order as traverse and transform
+    would call them, so a single walk for N visitors gives the same results as N separate walks.
+
+    >>> class CountVisitor(Visitor):
+    ...     def __init__(self, node_name: str):
+    ...         super().__init__(node_name)
+    ...         self.result = 0
+    ...
+    ...     def visit(self, node: dict):
+    ...         self.result += 1
+    >>> walker = Walker([CountVisitor('match'), CountVisitor('bool'), CountVisitor('must')])
+    >>> walker.traverse({'bool': {'must': [{'match': 'a'}, {'match': 'b'}]}})
+    [2, 1, 1]
+    """
+
+    def __init__(self, visitors: Iterable[Visitor]):
+        self.visitors = list(visitors)
+        self.table = {}
+        for visitor in self.visitors:
+            self.table.setdefault(visitor.node_name, []).append(visitor)
+
+    def traverse(self, query: dict) -> List:
+        """
+        Traverse down the query tree once, calling every visitor as traverse would. As with
+        traverse, the value of a matching node is not walked for visitors of that node name, but
+        it is still walked for the other visitors.
+
+        :param query: An ElasticSearch query.
+        :return: The value stored in the result of each visitor, in the order of the visitors.
+        """
+        table = self.table
+        # Each entry is (_DESCEND, node, names which may no longer match) or
+        # (_VISIT, node, visitors).
+        stack = [(_DESCEND, query, frozenset())]
+        while stack:
+            action, node, blocked = stack.pop()
+            if action == _VISIT:
+                for visitor in blocked:
+                    visitor.visit(node)
+                continue
+            node_type = type(node)
+            if node_type is list:
+                stack.extend((_DESCEND, child, blocked) for child in reversed(node))
+            elif node_type is dict or node_type is OrderedDict:
+                actions = []
+                for key, child in node.items():
+                    visitors = table.get(key)
+                    if visitors is None or key in blocked:
+                        actions.append((_DESCEND, child, blocked))
+                        continue
+                    actions.append((_VISIT, node, visitors))
+                    child_blocked = blocked | {key}
+                    # Only keep walking the value if some other visitor could still match in it.
+                    if len(child_blocked) < len(table):
+                        actions.append((_DESCEND, child, child_blocked))
+                actions.reverse()
+                stack.extend(actions)
+        return [visitor.result for visitor in self.visitors]
+
+    def transform(self, query: dict, in_place: bool = True) -> dict:
+        """
+        Transform the query, calling every visitor as transform would. When a node has a key
+        matching a visitor, the visitors of that key are called with the node and the rest of
+        the node (including the value of that key) is not walked. With several visitors, the first
+        key of a node (in order) which matches any visitor wins.
+
+        When in_place is False the query is not modified. Instead, each matching node is shallow
+        copied before it is visited, and only the dicts and lists on the path from the root to it
+        are copied; every other subtree is shared between the query and the result. Visitors
+        must then only set or delete keys of the node they are given, never modify its values.
+        A node which appears at several walked places of the query is visited once, and its copy
+        is linked into each of them. Unlike in place, references to it from parts of the query
+        which are not walked (such as the rest of a matching node) keep the original.
+
+        :param query: An ElasticSearch query.
+        :param in_place: Modify the query, rather than returning a copy which shares structure.
+        :return: A modified query, or what the visitors returned if the query itself matched.
+        """
+        table = self.table
+        root = query
+        returned = None
+        root_matched = False
+        copies = None if in_place else {}
+        # The ids of the nodes visited so far, kept apart from copies, which also holds the
+        # ancestors of visited nodes.
+        visited = set()
+        # Each entry is (action, node, visitors, path), where path is a linked list of
+        # (parent, key, path of parent) tuples which is only kept when not in_place.
+        stack = [(_DESCEND, query, None, None)]
+        while stack:
+            action, node, visitors, path = stack.pop()
+            if action == _VISIT:
+                is_root = node is root
+                if copies is not None:
+                    # A node reached again through another path was already visited, as it
+                    # would have been in place: its rewritten copy is only linked into this path.
+                    # A node may also have been copied before as the ancestor of a match, so
+                    # being copied does not mean being visited.
+                    seen = id(node) in visited
+                    visited.add(id(node))
+                    node = self._copy_path(node, path, copies)
+                    if seen:
+                        continue
+                value = self._visit_transform(node, visitors)
+                if is_root:
+                    returned, root_matched = value, True
+                continue
+            node_type = type(node)
+            if node_type is list:
+                if copies is None:
+                    stack.extend((_DESCEND, child, None, None) for child in reversed(node))
+                else:
+                    stack.extend((_DESCEND, node[i], None, (node, i, path))
+                                 for i in range(len(node) - 1, -1, -1))
+            elif node_type is dict or node_type is OrderedDict:
+                actions = []
+                for key, child in node.items():
+                    visitors = table.get(key)
+                    if visitors is not None:
+                        actions.append((_VISIT, node, visitors, path))
+                        break
+                    actions.append((_DESCEND, child, None,
+                                    None if copies is None else (node, key, path)))
+                actions.reverse()
+                stack.extend(actions)
+        if root_matched:
+            return returned
+        if copies is not None:
+            return copies.get(id(root), root)
+        return query
+
+    @staticmethod
+    def _copy_path(node, path, copies: dict):
+        """
+        Get the copy of a node, shallow copying it and each of its ancestors which has not been
+        copied yet, and linking the copy of each ancestor on the path to the copy of its child.
+        Copies are kept by identity, so a node which appears at several places in the query has
+        one copy linked into every path it is reached through. The whole path is linked every
+        time, since an ancestor copied through one path may itself be shared with another.
+
+        :return: The copy of the node
+        """
+        copy = copies.get(id(node))
+        if copy is None:
+            copy = copies[id(node)] = type(node)(node)
+        child = copy
+        while path is not None:
+            parent, key, path = path
+            parent_copy = copies.get(id(parent))
+            if parent_copy is None:
+                parent_copy = copies[id(parent)] = type(parent)(parent)
+            parent_copy[key] = child
+            child = parent_copy
+        return copy
 
-def traverse(query: dict, visitor: Visitor) -> Generic:
+    def _visit_transform(self, node: dict, visitors: List[Visitor]):
+        """
+        Call the visitors of a matching node during transform.
+
+        :return: The value returned by the last visitor
+        """
+        value = None
+        for visitor in visitors:
+            value = visitor.visit(node)
+        return value
+
+
+def count_nodes(query) -> int:
+    """
+    Count the nodes of a query: every dict, list and value in it.
+
+    >>> count_nodes({'bool': {'must': [{'match': 'a'}, {'match': 'b'}]}})
+    7
+
+    :param query: An ElasticSearch query or part of one
+    :return: The number of nodes
+    """
+    count = 0
+    stack = [query]
+    while stack:
+        node = stack.pop()
+        count += 1
+        if isinstance(node, dict):
+            stack.extend(node.values())
+        elif isinstance(node, list):
+            stack.extend(node)
+    return count
+
+
+@instrumented(count=lambda result, query, *args, **kwargs: count_nodes(query), unit='nodes')
+def traverse(query: dict, visitor: Visitor,
+             cache: 'irkit.query.cache.QueryCache' = None) -> Generic:
     """
     Traverse down the query tree using the specified visitor. Visitors used by this function 
     cannot modify the query. Instead they must store their return value into the result value
@@ -53,21 +270,17 @@ def traverse(query: dict, visitor: Visitor) -> Generic:
     
     :param query: An ElasticSearch query.
     :param visitor: An implemented Visitor class.
+    :param cache: An optional irkit.query.cache.QueryCache to reuse the walks of repeated queries.
     :return: The value stored in visitor.result.
     """
-    if type(query) is list:
-        for node in query:
-            traverse(node, visitor)
-    elif type(query) is dict or type(query) is OrderedDict:
-        for key in query.keys():
-            if key == visitor.node_name:
-                visitor.visit(query)
-            else:
-                traverse(query[key], visitor)
-    return visitor.result
-
-
-def transform(query: dict, visitor: Visitor) -> dict:
+    if cache is not None:
+        return cache.traverse(query, visitor)
+    return Walker([visitor]).traverse(query)[0]
+
+
+@instrumented(count=lambda result, *args, **kwargs: count_nodes(result), unit='nodes')
+def transform(query: dict, visitor: Visitor, cache: 'irkit.query.cache.QueryCache' = None,
+              in_place: bool = True) -> dict:
     """
     Transform the query using a visitor. Visitors used by this function modify the query
     in-place and should not return anything. The following example will transform all of the 
@@ -83,18 +296,34 @@ def transform(query: dict, visitor: Visitor) -> dict:
     >>> visitor = ExampleVisitor('must')
     >>> transform({'query': {'must': {'match': 'example'}}}, visitor) 
     {'query': {'must_not': {'match': 'example'}}}
-    
+
+    With in_place=False the query is left as it is and the result shares every subtree which
+    was not rewritten with it (see Walker.transform):
+
+    >>> query = {'query': {'must': {'match': 'example'}}, 'filter': {'term': 'x'}}
+    >>> rewritten = transform(query, visitor, in_place=False)
+    >>> query['query'], rewritten['query'], rewritten['filter'] is query['filter']
+    ({'must': {'match': 'example'}}, {'must_not': {'match': 'example'}}, True)
+
+    A subtree which appears at several places is rewritten once, and stays shared:
+
+    >>> shared = {'must': {'match': 'example'}}
+    >>> rewritten = transform({'a': shared, 'b': [shared]}, visitor, in_place=False)
+    >>> rewritten['b'][0], rewritten['a'] is rewritten['b'][0], shared
+    ({'must_not': {'match': 'example'}}, True, {'must': {'match': 'example'}})
+
+    A node is still visited when one of its children was rewritten before it:
+
+    >>> transform({'a': {'b': {'must': 1}, 'must': 2}}, visitor, in_place=False)
+    {'a': {'b': {'must_not': 1}, 'must_not': 2}}
+
     :param query: An ElasticSearch query.
     :param visitor: An implemented Visitor class.
+    :param cache: An optional irkit.query.cache.QueryCache to reuse the output of transforming
+                  repeated queries and subtrees.
+    :param in_place: Modify the query, rather than returning a copy which shares structure.
     :return: A modified query 
     """
-    if type(query) is list:
-        for node in query:
-            transform(node, visitor)
-    elif type(query) is dict or type(query) is OrderedDict:
-        for key in query.keys():
-            if key == visitor.node_name:
-                return visitor.visit(query)
-            else:
-                transform(query[key], visitor)
-    return query
+    if cache is not None:
+        return cache.transform(query, visitor, in_place)
+    return Walker([visitor]).transform(query, in_place)
@@ -0,0 +1,300 @@
+"""
+Execute ElasticSearch queries concurrently and turn the hits into trec_eval runs. Requests are
+sent with asyncio over a pool of keep-alive HTTP/1.1 connections; the size of the pool bounds the
+number of requests in flight. Failed requests (connection errors, timeouts and 429 or 5xx
+responses) are retried with exponential backoff.
+
+Usage:
+
+>>> executor = Executor('http://localhost:9200', index='pubmed', run_id='bm25')  # doctest: +SKIP
+>>> runs = executor.run({'1': {'query': {'match': {'text': 'heart attack'}}}})  # doctest: +SKIP
+
+The executor only needs an HTTP server answering ``POST /<index>/_search``, so it can be tested
+against a local stand-in server. This one fails the first request of every topic with a 503 (so
+each request is retried), sends the response of topic 2 in chunks, and answers topic 1 last:
+
+>>> import threading, time
+>>> from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+>>> failed = set()
+>>> class StandIn(BaseHTTPRequestHandler):
+...     protocol_version = 'HTTP/1.1'
+...
+...     def log_message(self, *args):
+...         pass
+...
+...     def do_POST(self):
+...         request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+...         topic = request['query']
+...         if topic not in failed:
+...             failed.add(topic)
+...             return self.reply(503, b'busy')
+...         if topic == '1':
+...             time.sleep(0.2)
+...         hits = [{'_id': 'D{}{}'.format(topic, i), '_score': 2 - i}
+...                 for i in range(request['size'])]
+...         self.reply(200, json.dumps({'hits': {'hits': hits}}).encode(), topic == '2')
+...
+...     def reply(self, status, body, chunked=False):
+...         self.send_response(status)
+...         if chunked:
+...             self.send_header('Transfer-Encoding', 'chunked')
+...             self.end_headers()
+...             for chunk in (body[:10], body[10:], b''):
+...                 self.wfile.write(b'%x\\r\\n%s\\r\\n' % (len(chunk), chunk))
+...         else:
+...             self.send_header('Content-Length', str(len(body)))
+...             self.end_headers()
+...             self.wfile.write(body)
+>>> server = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+>>> threading.Thread(target=server.serve_forever, daemon=True).start()
+>>> executor = Executor('http://127.0.0.1:{}'.format(server.server_port), index='test',
+...                     run_id='stand-in', size=2, backoff=0.01)
+>>> runs = executor.run({topic: {'query': topic} for topic in ('1', '2', '3')})
+>>> runs.topics(), runs.doc_id.tolist(), runs.rank.tolist()
+(['1', '2', '3'], ['D10', 'D11', 'D20', 'D21', 'D30', 'D31'], [1, 2, 1, 2, 1, 2])
+>>> sorted(failed)
+['1', '2', '3']
+>>> server.shutdown()
+>>> server.server_close()
+"""
+import asyncio
+import json
+from urllib.parse import urlsplit
+
+import numpy as np
+from typing import AsyncIterator, Dict, List, Tuple
+
+from irkit.trec.columns import ColumnBuilder
+from irkit.trec.run import TrecEvalRun, TrecEvalRuns
+
+# Response statuses which are worth retrying.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class HTTPError(Exception):
+    """
+    A request failed with an unexpected HTTP status.
+    """
+
+    def __init__(self, status: int, body: bytes):
+        super().__init__('HTTP {}: {}'.format(status, body[:200].decode('utf-8', 'replace')))
+        self.status = status
+        self.body = body
+
+
+class ConnectionPool(object):
+    """
+    A pool of keep-alive HTTP/1.1 connections to one host. At most ``size`` requests are in
+    flight at once; further requests wait for a connection to be released.
+    """
+
+    def __init__(self, url: str, size: int = 16, timeout: float = 30):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.ssl = parts.scheme == 'https'
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self._idle = []
+        self._semaphore = None
+        self._size = size
+
+    async def _open(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        return await asyncio.open_connection(self.host, self.port, ssl=self.ssl or None)
+
+    async def request(self, method: str, path: str, body: bytes = b'') -> Tuple[int, bytes]:
+        """
+        Send a request, reusing an idle connection if there is one.
+
+        :param method: The HTTP method
+        :param path: The path of the request (appended to the path of the pool's url)
+        :param body: The body of the request, sent as JSON
+        :return: The status and body of the response
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._size)
+        async with self._semaphore:
+            connection = self._idle.pop() if self._idle else await self._open()
+            try:
+                status, data, reusable = await asyncio.wait_for(
+                    self._exchange(connection, method, path, body), self.timeout)
+            except BaseException:
+                connection[1].close()
+                raise
+            if reusable:
+                self._idle.append(connection)
+            else:
+                connection[1].close()
+            return status, data
+
+    async def _exchange(self, connection, method: str, path: str, body: bytes):
+        reader, writer = connection
+        head = ('{} {}{} HTTP/1.1\r\nHost: {}:{}\r\nContent-Type: application/json\r\n'
+                'Content-Length: {}\r\nConnection: keep-alive\r\n\r\n').format(
+            method, self.prefix, path, self.host, self.port, len(body))
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Connection closed by server')
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        reusable = headers.get('connection', '').lower() != 'close'
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            data = b''.join(chunks)
+        elif 'content-length' in headers:
+            data = await reader.readexactly(int(headers['content-length']))
+        else:
+            data = await reader.read()
+            reusable = False
+        return status, data, reusable
+
+    def close(self) -> None:
+        """
+        Close the idle connections.
+        """
+        while self._idle:
+            self._idle.pop()[1].close()
+
+
+class Executor(object):
+    """
+    Send the query of each topic to ElasticSearch and convert the hits into TrecEvalRun rows.
+    Each query is a search request body; ``size`` and ``_source`` are added when missing.
+    """
+
+    def __init__(self, url: str = 'http://localhost:9200', index: str = None,
+                 run_id: str = 'irkit', size: int = 1000, max_in_flight: int = 16,
+                 retries: int = 3, backoff: float = 0.5, timeout: float = 30):
+        """
+        :param url: The url of the ElasticSearch server
+        :param index: The index (or comma separated indices) to search, or None for all
+        :param run_id: The run id of the rows
+        :param size: The number of hits to request for each topic
+        :param max_in_flight: The maximum number of concurrent requests (the pool size)
+        :param retries: How many times a failed request is retried
+        :param backoff: Seconds to wait before the first retry, doubling for each retry
+        :param timeout: Seconds to wait for each response
+        """
+        self.url = url
+        self.path = '/{}/_search'.format(index) if index else '/_search'
+        self.run_id = run_id
+        self.size = size
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+    async def search(self, pool: ConnectionPool, query: dict) -> dict:
+        """
+        Send one search request, retrying it if it fails.
+
+        :param pool: The connection pool to send the request with
+        :param query: A search request body
+        :return: The decoded response
+        """
+        body = dict(query)
+        body.setdefault('size', self.size)
+        body.setdefault('_source', False)
+        data = json.dumps(body).encode('utf-8')
+        for attempt in range(self.retries + 1):
+            try:
+                status, response = await pool.request('POST', self.path, data)
+                if status == 200:
+                    return json.loads(response.decode('utf-8'))
+                if status not in RETRY_STATUSES or attempt == self.retries:
+                    raise HTTPError(status, response)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                if attempt == self.retries:
+                    raise
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    def _rows(self, topic: str, response: dict) -> List[tuple]:
+        return [(topic, '0', hit['_id'], rank, hit.get('_score') or 0.0, self.run_id)
+                for rank, hit in enumerate(response['hits']['hits'], 1)]
+
+    async def iter_rows(self, queries: Dict[str, dict]) -> AsyncIterator[TrecEvalRun]:
+        """
+        Search for every topic concurrently, yielding the rows of each topic as soon as its
+        response arrives (so topics are in order of completion).
+
+        :param queries: A mapping of topic to search request body
+        :return: An asynchronous iterator of TrecEvalRun
+        """
+        async for _, rows in self._iter_topics(queries):
+            for row in rows:
+                yield TrecEvalRun(*row)
+
+    async def _iter_topics(self, queries: Dict[str, dict]):
+        pool = ConnectionPool(self.url, self.max_in_flight, self.timeout)
+        pending = set()
+        topics = iter(queries.items())
+
+        async def search(topic, query):
+            return topic, await self.search(pool, query)
+
+        def submit():
+            # Keep at most max_in_flight tasks, so huge topic sets are not all scheduled at once.
+            for topic, query in topics:
+                pending.add(asyncio.ensure_future(search(topic, query)))
+                if len(pending) >= self.max_in_flight:
+                    return
+
+        try:
+            submit()
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    pending.discard(task)
+                    topic, response = task.result()
+                    yield topic, self._rows(str(topic), response)
+                submit()
+        finally:
+            for task in pending:
+                task.cancel()
+            pool.close()
+
+    async def run_async(self, queries: Dict[str, dict]) -> TrecEvalRuns:
+        """
+        Search for every topic concurrently and collect the hits into runs, with the topics in
+        the order of the queries. Hits go straight into the columns of the runs, without
+        creating TrecEvalRun objects.
+
+        :param queries: A mapping of topic to search request body
+        :return: TrecEvalRuns
+        """
+        builder = ColumnBuilder(TrecEvalRuns)
+        async for _, rows in self._iter_topics(queries):
+            for row in rows:
+                builder.append(*row)
+        runs = builder.build()
+        order = [runs._index[str(topic)] for topic in queries if str(topic) in runs._index]
+        if not order:
+            return runs
+        return runs._take(np.concatenate([np.arange(rows.start, rows.stop) for rows in order]))
+
+    def run(self, queries: Dict[str, dict]) -> TrecEvalRuns:
+        """
+        Synchronous version of run_async.
+
+        :param queries: A mapping of topic to search request body
+        :return: TrecEvalRuns
+        """
+        return asyncio.run(self.run_async(queries))
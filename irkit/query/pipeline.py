@@ -0,0 +1,136 @@
+"""
+Process logs of ElasticSearch queries in bulk. A log has one JSON query per line and may be gzip
+compressed. The lines are read in batches which are handed to a pool of worker processes; each
+worker walks its batch with a Walker, so every query is parsed and walked once for all visitors.
+
+Visitors are created in the workers by a ``make_visitors`` function, which must be picklable (a
+module-level function, a class, or a functools.partial of one). Usage:
+
+>>> class TermVisitor(Visitor):
+...     def __init__(self):
+...         super().__init__('term')
+...         self.result = 0
+...
+...     def visit(self, node: dict):
+...         self.result += 1
+>>> log = ['{"bool": {"must": [{"term": "a"}, {"term": "b"}]}}', '{"term": "c"}']
+>>> traverse_log(log, lambda: [TermVisitor()], lambda a, b: a + b, processes=1)
+[3]
+"""
+import gzip
+import json
+import multiprocessing
+
+import io
+import itertools
+import os
+from collections import deque
+from functools import partial
+from typing import Callable, Iterable, Iterator, List, Sequence
+
+from irkit.query.elasticsearch import Visitor, Walker
+
+DEFAULT_BATCH_SIZE = 10000
+
+
+def open_log(path: str) -> io.TextIOWrapper:
+    """
+    Open a query log for reading, decompressing it if the path ends with .gz.
+
+    :param path: Path to a file with one JSON query per line
+    :return: A text file pointer
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt')
+    return open(path)
+
+
+def batches(lines: Iterable[str], batch_size: int) -> Iterator[List[str]]:
+    """
+    Group the non-blank lines of a log into lists of at most batch_size lines.
+    """
+    lines = (line for line in lines if line.strip())
+    while True:
+        batch = list(itertools.islice(lines, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _traverse_batch(make_visitors: Callable[[], Sequence[Visitor]], batch: List[str]) -> List:
+    walker = Walker(make_visitors())
+    results = None
+    for line in batch:
+        results = walker.traverse(json.loads(line))
+    return results
+
+
+def _transform_batch(make_visitors: Callable[[], Sequence[Visitor]], batch: List[str]) -> str:
+    walker = Walker(make_visitors())
+    return ''.join(json.dumps(walker.transform(json.loads(line))) + '\n' for line in batch)
+
+
+def _map(function: Callable, batches: Iterable, processes: int, in_flight: int) -> Iterator:
+    """
+    Apply a function to each batch in a process pool, yielding results in order. Unlike
+    Pool.imap, at most in_flight batches are read ahead, so memory stays bounded however long
+    the log is.
+    """
+    if processes == 1:
+        yield from map(function, batches)
+        return
+    with multiprocessing.Pool(processes) as pool:
+        pending = deque()
+        for batch in batches:
+            pending.append(pool.apply_async(function, (batch,)))
+            if len(pending) >= in_flight:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def traverse_log(lines: Iterable[str], make_visitors: Callable[[], Sequence[Visitor]],
+                 merge: Callable, processes: int = None,
+                 batch_size: int = DEFAULT_BATCH_SIZE) -> List:
+    """
+    Traverse every query of a log. Each batch gets new visitors from make_visitors, whose results
+    accumulate over the queries of the batch; the results of the batches are then combined
+    with merge, one visitor at a time and in the order of the log.
+
+    :param lines: The lines of a log (such as a file pointer from open_log)
+    :param make_visitors: A picklable function returning a list of new visitors
+    :param merge: A function combining two results of the same visitor
+    :param processes: Number of worker processes (defaults to the number of CPUs)
+    :param batch_size: Number of queries sent to a worker at a time
+    :return: The merged result of each visitor (None for every visitor if the log is empty)
+    """
+    processes = processes or os.cpu_count() or 1
+    merged = None
+    for results in _map(partial(_traverse_batch, make_visitors), batches(lines, batch_size),
+                        processes, 2 * processes):
+        if merged is None:
+            merged = list(results)
+        else:
+            merged = [merge(a, b) for a, b in zip(merged, results)]
+    if merged is None:
+        merged = [None for _ in make_visitors()]
+    return merged
+
+
+def transform_log(lines: Iterable[str], make_visitors: Callable[[], Sequence[Visitor]],
+                  output: io.TextIOWrapper, processes: int = None,
+                  batch_size: int = DEFAULT_BATCH_SIZE) -> None:
+    """
+    Transform every query of a log, writing the transformed queries to output as they are
+    produced, one JSON query per line and in the order of the log.
+
+    :param lines: The lines of a log (such as a file pointer from open_log)
+    :param make_visitors: A picklable function returning a list of new visitors
+    :param output: A text file pointer to write the transformed queries to
+    :param processes: Number of worker processes (defaults to the number of CPUs)
+    :param batch_size: Number of queries sent to a worker at a time
+    """
+    processes = processes or os.cpu_count() or 1
+    for text in _map(partial(_transform_batch, make_visitors), batches(lines, batch_size),
+                     processes, 2 * processes):
+        output.write(text)
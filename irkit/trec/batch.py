@@ -0,0 +1,84 @@
+"""
+Evaluate many run files against the same qrels in parallel. The qrels are loaded once and handed
+to each worker process when it starts: with the fork start method the workers share the parent's
+memory copy-on-write, otherwise the qrels are pickled once per worker rather than once per run.
+Each worker parses its own run files, so only the results are sent back to the parent.
+
+Command line usage:
+
+``trecbatch --qrels qrels.txt --runs run1.txt run2.txt --output results/``
+"""
+import argparse
+import multiprocessing
+
+import os
+from functools import partial
+from typing import List, Sequence
+
+import irkit.trec.qrels
+import irkit.trec.run
+from irkit.trec.evaluate import DEFAULT_CUTOFFS, evaluate
+from irkit.trec.qrels import Qrels
+from irkit.trec.results import TrecEvalResults
+
+# The qrels of the current worker process, set by _init_worker.
+_worker_qrels = None
+
+
+def _init_worker(qrels: Qrels) -> None:
+    global _worker_qrels
+    _worker_qrels = qrels
+
+
+def _evaluate_file(path: str, **kwargs) -> TrecEvalResults:
+    with open(path) as fp:
+        runs = irkit.trec.run.load(fp)
+    return evaluate(_worker_qrels, runs, **kwargs)
+
+
+def _context():
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+
+def evaluate_files(qrels: Qrels, paths: Sequence[str], processes: int = None,
+                   cutoffs: Sequence[int] = DEFAULT_CUTOFFS,
+                   relevance_level: int = 1) -> List[TrecEvalResults]:
+    """
+    Evaluate run files against qrels using a pool of worker processes.
+
+    :param qrels: The relevance judgements, shared by every worker
+    :param paths: Paths to trec_eval run files
+    :param processes: Number of worker processes (defaults to the number of CPUs)
+    :param cutoffs: Ranks at which to compute precision and recall
+    :param relevance_level: Minimum relevancy for a document to be considered relevant
+    :return: A TrecEvalResults object for each run file, in the same order as the paths
+    """
+    work = partial(_evaluate_file, cutoffs=cutoffs, relevance_level=relevance_level)
+    processes = min(processes or os.cpu_count() or 1, max(len(paths), 1))
+    with _context().Pool(processes, initializer=_init_worker, initargs=(qrels,)) as pool:
+        return pool.map(work, paths, chunksize=1)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Evaluate many run files against qrels.')
+
+    argparser.add_argument('--qrels', help='qrels file.', required=True,
+                           type=argparse.FileType('r'))
+    argparser.add_argument('--runs', help='trec_eval run files.', required=True, nargs='+')
+    argparser.add_argument('--processes', help='Number of worker processes.', type=int,
+                           default=None, required=False)
+    argparser.add_argument('--output', help='Directory to write a results file for each run to '
+                                            '(defaults to printing the results).',
+                           type=str, default=None, required=False)
+
+    args = argparser.parse_args()
+    qrels = irkit.trec.qrels.load(args.qrels)
+    for path, results in zip(args.runs, evaluate_files(qrels, args.runs, args.processes)):
+        if args.output is None:
+            print(results.dumps())
+        else:
+            os.makedirs(args.output, exist_ok=True)
+            with open(os.path.join(args.output, os.path.basename(path) + '.results'), 'w') as f:
+                results.dump(f)
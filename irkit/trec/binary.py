@@ -0,0 +1,141 @@
+"""
+A compact binary file format for column-oriented trec files, which can be memory-mapped so that
+reloading a parsed file is near-instant. A file consists of:
+
+- the magic bytes ``IRKITCOL``, a little-endian uint32 version and a uint32 header length,
+- a JSON header describing the type, the location of each column and string table, and the
+  topic index,
+- the string tables (newline separated utf-8) and the column arrays, each aligned to 8 bytes.
+
+Numeric columns and codes are returned as read-only views of the memory map, so loading does not
+copy them; only the string tables are decoded.
+"""
+import json
+import mmap
+import struct
+
+import os
+import numpy as np
+from collections import OrderedDict
+from typing import Callable
+
+MAGIC = b'IRKITCOL'
+VERSION = 1
+ALIGNMENT = 8
+
+# The suffix added to the path of a text file for its binary cache.
+CACHE_SUFFIX = '.irkit'
+
+
+def _padding(offset: int) -> int:
+    return -offset % ALIGNMENT
+
+
+def dump(columns, path: str) -> None:
+    """
+    Write a Columns object (such as TrecEvalRuns or Qrels) to a binary file.
+
+    :param columns: The object to write
+    :param path: Path of the file to write
+    """
+    blobs = []
+    header = {'type': type(columns).__name__, 'length': len(columns), 'tables': {},
+              'columns': {}, 'index': [[topic, rows.start, rows.stop]
+                                       for topic, rows in columns._index.items()]}
+    for field, table in columns._tables.items():
+        data = '\n'.join(table).encode('utf-8')
+        if len(table) and data.count(b'\n') != len(table) - 1:
+            raise Exception('Cannot write values containing newlines in {}'.format(field))
+        header['tables'][field] = {'count': len(table), 'size': len(data)}
+        blobs.append((header['tables'][field], data))
+    for field in columns._fields:
+        column = np.ascontiguousarray(columns._columns[field])
+        header['columns'][field] = {'dtype': column.dtype.str, 'count': len(column)}
+        blobs.append((header['columns'][field], memoryview(column).cast('B')))
+
+    # Offsets are relative to the start of the data, which follows the header.
+    offset = 0
+    for description, data in blobs:
+        offset += _padding(offset)
+        description['offset'] = offset
+        offset += len(data)
+    encoded = json.dumps(header).encode('utf-8')
+    start = len(MAGIC) + 8 + len(encoded)
+    encoded += b' ' * _padding(start)
+
+    with open(path, 'wb') as fp:
+        fp.write(MAGIC + struct.pack('<II', VERSION, len(encoded)) + encoded)
+        position = 0
+        for description, data in blobs:
+            fp.write(b'\0' * (description['offset'] - position))
+            fp.write(data)
+            position = description['offset'] + len(data)
+
+
+def load(columns_type: type, path: str):
+    """
+    Load a Columns object from a binary file. The columns are memory-mapped views of the file.
+
+    :param columns_type: The class of the object stored in the file
+    :param path: Path of the file to read
+    :return: An object of columns_type
+    """
+    with open(path, 'rb') as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise Exception('{} is not an irkit binary file'.format(path))
+        version, header_size = struct.unpack('<II', fp.read(8))
+        if version != VERSION:
+            raise Exception('Unsupported irkit binary file version {}'.format(version))
+        header = json.loads(fp.read(header_size).decode('utf-8'))
+        if header['type'] != columns_type.__name__:
+            raise Exception('{} contains {}, not {}'.format(path, header['type'],
+                                                            columns_type.__name__))
+        buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    start = len(MAGIC) + 8 + header_size
+
+    tables = {}
+    for field, description in header['tables'].items():
+        offset = start + description['offset']
+        data = bytes(buffer[offset:offset + description['size']]).decode('utf-8')
+        tables[field] = data.split('\n') if description['count'] else []
+    columns = {}
+    for field, description in header['columns'].items():
+        columns[field] = np.frombuffer(buffer, dtype=np.dtype(description['dtype']),
+                                       count=description['count'],
+                                       offset=start + description['offset'])
+    index = OrderedDict((topic, slice(begin, end)) for topic, begin, end in header['index'])
+
+    obj = columns_type.__new__(columns_type)
+    obj._assign(tables, columns, index)
+    return obj
+
+
+def load_cached(columns_type: type, path: str, load_text: Callable, cache_path: str = None):
+    """
+    Load a text file through its binary cache. The cache is used if it is at least as new as the
+    text file, otherwise the text file is parsed and the cache is (re)written if possible.
+
+    :param columns_type: The class of the object stored in the file
+    :param path: Path of the text file
+    :param load_text: A function which parses a text file pointer into an object of columns_type
+    :param cache_path: Path of the binary cache (defaults to the path with CACHE_SUFFIX appended)
+    :return: An object of columns_type
+    """
+    if cache_path is None:
+        cache_path = path + CACHE_SUFFIX
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        return load(columns_type, cache_path)
+    with open(path) as fp:
+        columns = load_text(fp)
+    # Write to a temporary file first so a concurrent reader never sees a partial cache. The cache
+    # is only an optimisation, so failing to write it (e.g. in a read-only directory) is ignored.
+    temporary = '{}.{}.tmp'.format(cache_path, os.getpid())
+    try:
+        dump(columns, temporary)
+        os.replace(temporary, cache_path)
+    except OSError:
+        try:
+            os.remove(temporary)
+        except OSError:
+            pass
+    return columns
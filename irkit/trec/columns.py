@@ -0,0 +1,500 @@
+"""
+Column-oriented storage shared by the trec file representations. Instead of keeping one python
+object per line of a file, the lines are stored as contiguous numpy arrays: string fields (topic
+ids, document ids, ...) are interned into a table of unique values plus an array of integer codes,
+and numeric fields are stored as typed arrays. Row objects are only created when iterating.
+"""
+import gzip
+import re
+from array import array
+from collections import OrderedDict
+
+import os
+
+import numpy as np
+from typing import Dict, Iterable, Iterator, List
+
+import irkit.trec.binary
+
+# Number of rows decoded at a time when iterating over the rows of a Columns object.
+ITER_CHUNK_SIZE = 65536
+
+# Approximate number of characters read from a file at a time by the bulk tokenizer.
+PARSE_CHUNK_SIZE = 1 << 26
+
+# The token marking the end of each line for the bulk tokenizer, and blank lines it removes.
+_END_OF_LINE = '\x00'
+_BLANK_LINE = re.compile(r'\n[^\S\n]*(?=\n)')
+
+
+def _converter(dtype) -> type:
+    return int if np.dtype(dtype).kind in 'iu' else float
+
+
+class Columns(object):
+    """
+    Base class for a table of rows stored column-wise. Subclasses describe their rows with:
+
+    - ``_row_type``: the class of a single row, constructed with the fields in ``_fields`` order.
+    - ``_fields``: the names of the fields of a row, in constructor order.
+    - ``_string_fields``: the fields which are interned into a string table.
+    - ``_numeric_fields``: a mapping of the remaining fields to their numpy dtype.
+    - ``_line_format``: a format string which formats the fields of a row as a line of the file.
+    - ``_document_field``: the string field identifying a document within a topic.
+
+    Rows are kept grouped by topic: when the rows of a topic are not contiguous they are stably
+    reordered so that they are. An index from each topic to its slice of rows is built when the
+    columns are assigned, so indexing by topic is a dictionary lookup returning a view.
+    """
+
+    _row_type = None
+    _fields = ()
+    _string_fields = ()
+    _numeric_fields = {}
+    _topic_field = 'topic'
+    _document_field = None
+    _line_format = None
+
+    def __init__(self, rows: Iterable = ()):
+        if isinstance(rows, Columns):
+            self._assign(rows._tables, rows._columns)
+        else:
+            builder = ColumnBuilder(type(self))
+            for row in rows:
+                builder.append(*[getattr(row, field) for field in self._fields])
+            self._assign(*builder.columns())
+
+    @classmethod
+    def from_columns(cls, tables: Dict[str, List[str]], columns: Dict[str, np.ndarray]):
+        """
+        Create an object directly from string tables and column arrays without building rows.
+
+        :param tables: A string table for each of the string fields.
+        :param columns: The codes for each string field and the values for each numeric field.
+        :return: A new object of this class
+        """
+        obj = cls.__new__(cls)
+        obj._assign(tables, columns)
+        return obj
+
+    def dump_binary(self, path: str) -> None:
+        """
+        Write the columns to a binary file which can be memory-mapped by load_binary.
+
+        :param path: Path of the file to write
+        """
+        irkit.trec.binary.dump(self, path)
+
+    @classmethod
+    def load_binary(cls, path: str):
+        """
+        Load an object written by dump_binary. The columns are read-only views of a memory map
+        of the file, so loading does not parse or copy them.
+
+        :param path: Path of the file to read
+        :return: A new object of this class
+        """
+        return irkit.trec.binary.load(cls, path)
+
+    def _assign(self, tables: Dict[str, List[str]], columns: Dict[str, np.ndarray],
+                index: Dict[str, slice] = None) -> None:
+        if index is None:
+            columns, index = self._group(tables, columns)
+        for field in self._fields:
+            columns[field].flags.writeable = False
+        self._tables = tables
+        self._columns = columns
+        self._index = index
+        self._object_tables = {}
+
+    def _group(self, tables: Dict[str, List[str]], columns: Dict[str, np.ndarray]):
+        """
+        Make the rows of each topic contiguous (keeping topics in order of first appearance and
+        rows in their original order within a topic) and build the topic index.
+        """
+        codes = columns[self._topic_field]
+        if len(codes) == 0:
+            return columns, OrderedDict()
+        starts = np.flatnonzero(np.concatenate(([True], codes[1:] != codes[:-1])))
+        if len(np.unique(codes[starts])) != len(starts):
+            _, first, inverse = np.unique(codes, return_index=True, return_inverse=True)
+            appearance = np.empty(len(first), dtype=np.int64)
+            appearance[np.argsort(first)] = np.arange(len(first))
+            order = np.argsort(appearance[inverse.ravel()], kind='stable')
+            columns = {field: column[order] for field, column in columns.items()}
+            codes = columns[self._topic_field]
+            starts = np.flatnonzero(np.concatenate(([True], codes[1:] != codes[:-1])))
+        stops = np.append(starts[1:], len(codes))
+        table = tables[self._topic_field]
+        index = OrderedDict((table[code], slice(start, stop)) for code, start, stop in
+                            zip(codes[starts].tolist(), starts.tolist(), stops.tolist()))
+        return columns, index
+
+    def _table(self, field: str) -> np.ndarray:
+        """
+        The string table of a field as a numpy object array so that codes can be decoded with
+        fancy indexing.
+        """
+        if field not in self._object_tables:
+            table = np.empty(len(self._tables[field]), dtype=object)
+            table[:] = self._tables[field]
+            self._object_tables[field] = table
+        return self._object_tables[field]
+
+    def _take(self, index):
+        """
+        Select rows using a numpy index (a slice, boolean mask or array of row numbers).
+        String tables are shared with this object.
+        """
+        return self.from_columns(self._tables,
+                                 {field: self._columns[field][index] for field in self._fields})
+
+    def topics(self) -> List[str]:
+        """
+        :return: The topics, in the order they appear.
+        """
+        return list(self._index)
+
+    def _topic_rows(self, topic):
+        """
+        The rows of a topic as a new object whose columns are views of the columns of this one.
+        Topics are looked up as strings, so numeric topic ids can be given as numbers. Slices are
+        refused rather than looked up as topics (which would silently give no rows).
+        """
+        if isinstance(topic, slice):
+            raise TypeError('Rows are indexed by topic, not sliced; use row() or iterate')
+        rows = self._index.get(str(topic), slice(0, 0))
+        obj = self.__class__.__new__(self.__class__)
+        obj._assign(self._tables, {field: self._columns[field][rows] for field in self._fields},
+                    OrderedDict([(str(topic), slice(0, rows.stop - rows.start))])
+                    if rows.stop > rows.start else OrderedDict())
+        return obj
+
+    def row(self, position: int):
+        """
+        Get a single row by its position.
+
+        :param position: The position of the row (negative positions count from the end)
+        :return: An object of the row type
+        """
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError('Row {} out of range'.format(position))
+        return self._row_type(*[values[0] for values in
+                                self._decode(slice(position, position + 1))])
+
+    def _drop_topic(self, topic) -> None:
+        """
+        Remove the rows of a topic, shifting the slices of the topics after it in the index.
+        """
+        rows = self._index.get(str(topic))
+        if rows is None:
+            return
+        size = rows.stop - rows.start
+        columns = {field: np.concatenate((column[:rows.start], column[rows.stop:]))
+                   for field, column in self._columns.items()}
+        index = OrderedDict()
+        for other, other_rows in self._index.items():
+            if other_rows.start > rows.start:
+                index[other] = slice(other_rows.start - size, other_rows.stop - size)
+            elif other_rows is not rows:
+                index[other] = other_rows
+        self._assign(self._tables, columns, index)
+
+    def column(self, field: str) -> np.ndarray:
+        """
+        Access a column. Numeric fields are returned as a read-only view of the underlying
+        array, string fields are decoded from the string table.
+
+        :param field: One of the fields of a row
+        :return: The column as a numpy array
+        """
+        if field in self._numeric_fields:
+            return self._columns[field]
+        if field in self._string_fields:
+            return self._table(field)[self._columns[field]]
+        raise AttributeError(field)
+
+    def __getattr__(self, field):
+        # Internal attributes are never columns; this also keeps pickling and copying working
+        # before __dict__ has been populated.
+        if field.startswith('_'):
+            raise AttributeError(field)
+        return self.column(field)
+
+    def __len__(self):
+        return len(self._columns[self._fields[0]])
+
+    def _decode(self, rows: slice) -> List[list]:
+        """
+        Decode a slice of rows into a python list of values for each field.
+        """
+        values = []
+        for field in self._fields:
+            column = self._columns[field][rows]
+            if field in self._string_fields:
+                table = self._tables[field]
+                values.append([table[code] for code in column.tolist()])
+            else:
+                values.append(column.tolist())
+        return values
+
+    def _format_values(self, field: str, values: list) -> list:
+        """
+        Convert decoded values of a field into the values given to the line format.
+        """
+        return values
+
+    def _chunks(self, chunk_size: int) -> Iterator[slice]:
+        for start in range(0, len(self), chunk_size):
+            yield slice(start, start + chunk_size)
+
+    def __iter__(self) -> Iterator:
+        for chunk in self._chunks(ITER_CHUNK_SIZE):
+            for row in zip(*self._decode(chunk)):
+                yield self._row_type(*row)
+
+    def iter_lines(self, chunk_size: int = ITER_CHUNK_SIZE) -> Iterator[str]:
+        """
+        Format the rows as text a chunk at a time, without creating row objects.
+
+        :param chunk_size: The number of rows in each chunk
+        :return: For each chunk, the lines of its rows joined by os.linesep
+        """
+        line_format = self._line_format.format
+        for chunk in self._chunks(chunk_size):
+            values = [self._format_values(field, column)
+                      for field, column in zip(self._fields, self._decode(chunk))]
+            yield os.linesep.join([line_format(*row) for row in zip(*values)])
+
+    def __str__(self):
+        return os.linesep.join(self.iter_lines())
+
+    def _write(self, fp, chunk_size: int) -> None:
+        """
+        Write the rows to a text file a chunk at a time, so at most one chunk of text is in memory.
+        The output is the same as str(self).
+        """
+        separator = ''
+        for lines in self.iter_lines(chunk_size):
+            fp.write(separator)
+            fp.write(lines)
+            separator = os.linesep
+
+    def dump_file(self, path: str, compress: bool = None,
+                  chunk_size: int = ITER_CHUNK_SIZE) -> None:
+        """
+        Write the rows to a file, streaming a chunk of rows at a time.
+
+        :param path: Path of the file to write
+        :param compress: Write a gzip file (defaults to whether the path ends with .gz)
+        :param chunk_size: The number of rows formatted and written at a time
+        """
+        if compress is None:
+            compress = path.endswith('.gz')
+        with (gzip.open(path, 'wt') if compress else open(path, 'w')) as fp:
+            self._write(fp, chunk_size)
+
+
+def split_lines(lines: Iterable[str]) -> Iterator[List[str]]:
+    """
+    Split lines into whitespace separated fields, skipping blank lines.
+
+    :param lines: An iterable of lines, such as a file pointer
+    :return: The fields of each non-blank line
+    """
+    for line in lines:
+        fields = line.split()
+        if fields:
+            yield fields
+
+
+def iter_groups(columns_type: type, lines: Iterable[List[str]]) -> Iterator:
+    """
+    Group consecutive lines of the same topic into Columns objects. Only the lines of the current
+    topic are held in memory. A topic which appears again later in the lines is yielded again.
+
+    :param columns_type: The Columns class to build
+    :param lines: The fields of each line
+    :return: A Columns object for each run of consecutive lines with the same topic
+    """
+    position = columns_type._fields.index(columns_type._topic_field)
+    builder = ColumnBuilder(columns_type)
+    topic = None
+    for fields in lines:
+        if fields[position] != topic and len(builder):
+            yield builder.build()
+            builder = ColumnBuilder(columns_type)
+        topic = fields[position]
+        builder.append(*fields)
+    if len(builder):
+        yield builder.build()
+
+
+def read_chunks(fp, size: int = PARSE_CHUNK_SIZE) -> Iterator[str]:
+    """
+    Read a file in chunks of whole lines.
+
+    :param fp: File pointer
+    :param size: Approximate number of characters in each chunk
+    :return: Chunks of text, each ending at the end of a line
+    """
+    while True:
+        lines = fp.readlines(size)
+        if not lines:
+            return
+        yield ''.join(lines)
+
+
+def _tokenize(chunk: str, n_fields: int) -> List[str]:
+    """
+    Split a chunk of text into tokens with str.split, following the fields of each line with an
+    end of line token, and check that every non-blank line has n_fields fields: the end of line
+    tokens must be exactly every (n_fields + 1)th token.
+    """
+    chunk = chunk.strip()
+    if not chunk:
+        return []
+    if _BLANK_LINE.search(chunk):
+        chunk = _BLANK_LINE.sub('', chunk)
+    tokens = (chunk + '\n').replace('\n', ' {} '.format(_END_OF_LINE)).split()
+    lines = tokens.count(_END_OF_LINE)
+    if len(tokens) != (n_fields + 1) * lines or \
+            tokens[n_fields::n_fields + 1].count(_END_OF_LINE) != lines:
+        _check_lines(chunk, n_fields)
+    return tokens
+
+
+def _check_lines(chunk: str, n_fields: int) -> None:
+    """
+    Raise on the first non-blank line of a chunk which does not have n_fields fields.
+    """
+    for line in chunk.split('\n'):
+        values = line.split()
+        if values and len(values) != n_fields:
+            raise ValueError('Expected {} fields, got {}: {}'.format(n_fields, len(values),
+                                                                    values))
+    raise ValueError('Expected {} fields on every line'.format(n_fields))
+
+
+def parse_bulk(columns_type: type, chunks: Iterable[str]):
+    """
+    Parse text into a Columns object with a bulk tokenizer. Each chunk is split into tokens with a
+    single call to str.split, and each column is then a strided slice of the tokens which is
+    interned or converted with numpy.fromiter, avoiding any per-line python work. Every line must
+    contain exactly the fields of the row type: the end of each line is marked by a token, so a
+    line with a missing or extra field raises a ValueError, as it does when parsing line by line.
+
+    >>> from irkit.trec.qrels import Qrels
+    >>> parse_bulk(Qrels, ['1 0 111 1\\n1 0 222\\n2 0 333 0 7\\n'])
+    Traceback (most recent call last):
+    ...
+    ValueError: Expected 4 fields, got 3: ['1', '0', '222']
+
+    :param columns_type: The Columns class to build
+    :param chunks: Chunks of text made of whole lines
+    :return: An object of columns_type
+    """
+    fields = columns_type._fields
+    lookups = {field: {} for field in columns_type._string_fields}
+    parts = {field: [] for field in fields}
+    for chunk in chunks:
+        tokens = _tokenize(chunk, len(fields))
+        count = len(tokens) // (len(fields) + 1)
+        for position, field in enumerate(fields):
+            values = tokens[position::len(fields) + 1]
+            if field in lookups:
+                lookup = lookups[field]
+                for value in dict.fromkeys(values):
+                    if value not in lookup:
+                        lookup[value] = len(lookup)
+                parts[field].append(np.fromiter(map(lookup.__getitem__, values),
+                                                dtype=np.int32, count=count))
+            else:
+                dtype = columns_type._numeric_fields[field]
+                parts[field].append(np.fromiter(map(_converter(dtype), values),
+                                                dtype=dtype, count=count))
+        del tokens
+    tables = {field: list(lookup) for field, lookup in lookups.items()}
+    columns = {}
+    for field in fields:
+        dtype = columns_type._numeric_fields.get(field, np.int32)
+        columns[field] = np.concatenate(parts[field]).astype(dtype, copy=False) \
+            if parts[field] else np.zeros(0, dtype=dtype)
+    return columns_type.from_columns(tables, columns)
+
+
+class ColumnBuilder(object):
+    """
+    Accumulate rows for a Columns class one at a time, interning the string fields as they
+    arrive. Values are kept in compact typed arrays rather than python lists of objects.
+    """
+
+    def __init__(self, columns_type: type):
+        self.columns_type = columns_type
+        self._interned = {field: {} for field in columns_type._string_fields}
+        self._codes = {field: array('i') for field in columns_type._string_fields}
+        self._values = {field: array(np.dtype(dtype).char)
+                        for field, dtype in columns_type._numeric_fields.items()}
+        self._convert = {field: _converter(dtype)
+                         for field, dtype in columns_type._numeric_fields.items()}
+
+    def append(self, *values) -> None:
+        """
+        Add a row. The values are given in the order of the fields of the row type.
+
+        >>> from irkit.trec.run import TrecEvalRuns
+        >>> ColumnBuilder(TrecEvalRuns).append('1', '0', 'D1', '1')
+        Traceback (most recent call last):
+        ...
+        ValueError: Expected 6 fields, got 4: ['1', '0', 'D1', '1']
+        """
+        fields = self.columns_type._fields
+        if len(values) != len(fields):
+            raise ValueError('Expected {} fields, got {}: {}'.format(len(fields), len(values),
+                                                                    list(values)))
+        for field, value in zip(fields, values):
+            if field in self._interned:
+                interned = self._interned[field]
+                value = str(value)
+                code = interned.get(value)
+                if code is None:
+                    code = interned[value] = len(interned)
+                self._codes[field].append(code)
+            else:
+                self._values[field].append(self._convert[field](value))
+
+    def extend(self, lines: Iterable[List[str]]):
+        """
+        Add the fields of many lines.
+
+        :param lines: The fields of each line, in the order of the fields of the row type
+        :return: This builder
+        """
+        for fields in lines:
+            self.append(*fields)
+        return self
+
+    def __len__(self):
+        return len(self._codes[self.columns_type._string_fields[0]])
+
+    def columns(self):
+        """
+        :return: The string tables and column arrays of the rows added so far.
+        """
+        tables = {field: list(interned) for field, interned in self._interned.items()}
+        columns = {field: np.frombuffer(codes, dtype=np.intc).astype(np.int32, copy=False)
+                   if len(codes) else np.zeros(0, dtype=np.int32)
+                   for field, codes in self._codes.items()}
+        for field, dtype in self.columns_type._numeric_fields.items():
+            values = self._values[field]
+            columns[field] = np.frombuffer(values, dtype=dtype) if len(values) \
+                else np.zeros(0, dtype=dtype)
+        return tables, columns
+
+    def build(self):
+        """
+        :return: A new object of the Columns class containing the rows added so far.
+        """
+        return self.columns_type.from_columns(*self.columns())
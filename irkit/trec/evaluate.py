@@ -0,0 +1,278 @@
+"""
+Evaluate runs against qrels in-process, without calling the trec_eval binary. Measures follow
+trec_eval's definitions: documents of a topic are ranked by decreasing score with ties broken by
+decreasing document id (the rank column is ignored), a document is relevant when its relevancy is
+at least the relevance level, and only topics present in both the run and the qrels are
+evaluated. All measures are computed for every topic at once with numpy.
+
+Usage:
+
+>>> from irkit.trec import qrels, run
+>>> q = qrels.loads('1 0 D1 1\\n1 0 D2 0\\n1 0 D3 1\\n2 0 D1 2')
+>>> r = run.loads('1 0 D1 1 3 test\\n1 0 D2 2 2 test\\n1 0 D3 3 1 test\\n2 0 D9 1 1 test')
+>>> results = evaluate(q, r)
+>>> results.run_id
+'test'
+>>> results['1']['map']
+0.8333333333333333
+>>> round(results.results['map'], 4), results.results['P_5'], results.results['num_rel_ret']
+(0.4167, 0.2, 2)
+"""
+from collections import OrderedDict
+
+import numpy as np
+from typing import Dict, Iterable, Iterator, Optional, Sequence, Tuple
+
+from irkit.instrument import instrumented
+from irkit.trec.columns import ColumnBuilder
+from irkit.trec.qrels import Qrels
+from irkit.trec.results import TrecEvalResults
+from irkit.trec.run import TrecEvalRun, TrecEvalRuns
+
+DEFAULT_CUTOFFS = (5, 10, 15, 20, 30, 100, 200, 500, 1000)
+RECALL_LEVELS = tuple(i / 10 for i in range(11))
+
+# Measures which are summed rather than averaged over topics.
+SUMMED_MEASURES = ('num_ret', 'num_rel', 'num_rel_ret')
+
+
+def _group_max(values: np.ndarray, groups: np.ndarray, n_groups: int) -> np.ndarray:
+    out = np.zeros(n_groups)
+    np.maximum.at(out, groups, values)
+    return out
+
+
+@instrumented(count=lambda results, qrels, runs, *args, **kwargs: len(runs))
+def evaluate(qrels: Qrels, runs: TrecEvalRuns, cutoffs: Sequence[int] = DEFAULT_CUTOFFS,
+             relevance_level: int = 1, run_id: str = None) -> TrecEvalResults:
+    """
+    Evaluate runs against qrels. The measures computed for each topic are num_ret, num_rel,
+    num_rel_ret, map, Rprec, ndcg, iprec_at_recall_0.00 to iprec_at_recall_1.00, and P_k and
+    recall_k for each cutoff k. The results over all topics are the sum of the num_* measures and
+    the mean of the others. Like trec_eval, runs which retrieve a document more than once for a
+    topic are refused (TrecEvalRuns.normalise removes the duplicates):
+
+    >>> from irkit.trec import qrels, run
+    >>> evaluate(qrels.loads('1 0 D1 1'), run.loads('1 0 D1 1 3 r\\n1 0 D1 2 2 r'))
+    Traceback (most recent call last):
+    ...
+    ValueError: Document D1 is retrieved more than once for topic 1
+
+    :param qrels: The relevance judgements
+    :param runs: The runs to evaluate
+    :param cutoffs: Ranks at which to compute precision and recall
+    :param relevance_level: Minimum relevancy for a document to be considered relevant
+    :param run_id: The run id of the results (defaults to the run id of the first run)
+    :return: TrecEvalResults object
+    """
+    if run_id is None:
+        run_id = runs.run_id[0] if len(runs) else ''
+
+    # Only evaluate the topics which are both in the run and in the qrels.
+    topics = [topic for topic in runs.topics() if topic in qrels._index]
+    if len(topics) != len(runs.topics()):
+        runs = TrecEvalRuns.from_columns(runs._tables, {
+            field: np.concatenate([runs._columns[field][runs._index[topic]] for topic in topics])
+            if topics else runs._columns[field][:0] for field in runs._fields})
+    n_topics = len(topics)
+
+    # trec_eval refuses runs which retrieve a document twice for a topic.
+    sizes = np.array([rows.stop - rows.start for rows in runs._index.values()], dtype=np.int64)
+    group = np.repeat(np.arange(n_topics), sizes)
+    keys = group * max(len(runs._tables['doc_id']), 1) + runs._columns['doc_id']
+    unique_keys, first = np.unique(keys, return_index=True)
+    if len(unique_keys) < len(keys):
+        duplicate = np.setdiff1d(np.arange(len(keys)), first)[0]
+        raise ValueError('Document {} is retrieved more than once for topic {}'.format(
+            runs._tables['doc_id'][runs._columns['doc_id'][duplicate]], topics[group[duplicate]]))
+
+    # Rank documents by decreasing score, breaking ties by decreasing document id.
+    doc_order = np.empty(len(runs._tables['doc_id']), dtype=np.int64)
+    doc_order[np.argsort(np.array(runs._tables['doc_id'], dtype=object), kind='stable')] = \
+        np.arange(len(doc_order))
+    order = np.lexsort((-doc_order[runs._columns['doc_id']], -runs._columns['score'], group))
+    relevancy = qrels.annotate(runs).astype(np.int64)[order]
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1])).astype(np.int64)
+    rank = np.arange(len(group)) - starts[group] + 1
+
+    relevant = relevancy >= relevance_level
+    cumulative = np.cumsum(relevant)
+    rel_so_far = cumulative - (cumulative[starts] - relevant[starts])[group] if len(group) \
+        else cumulative
+
+    # The number of relevant documents and the ideal gains of each topic come from the qrels.
+    num_rel = np.zeros(n_topics)
+    ideal = np.zeros(n_topics)
+    for i, topic in enumerate(topics):
+        levels = qrels._columns['relevancy'][qrels._index[topic]]
+        num_rel[i] = np.count_nonzero(levels >= relevance_level)
+        gains = np.sort(levels[levels > 0])[::-1]
+        ideal[i] = np.sum(gains / np.log2(np.arange(2, len(gains) + 2)))
+    safe_num_rel = np.maximum(num_rel, 1)
+
+    num_ret = sizes.astype(np.float64)
+    num_rel_ret = np.bincount(group, weights=relevant, minlength=n_topics)
+    precision = np.where(relevant, rel_so_far / rank, 0)
+    measures = [('num_ret', num_ret), ('num_rel', num_rel), ('num_rel_ret', num_rel_ret),
+                ('map', np.bincount(group, weights=precision, minlength=n_topics) / safe_num_rel)]
+
+    in_r = relevant & (rank <= num_rel[group])
+    measures.append(('Rprec', np.bincount(group, weights=in_r, minlength=n_topics)
+                     / safe_num_rel))
+
+    gain = np.where(relevancy > 0, relevancy, 0) / np.log2(rank + 1)
+    dcg = np.bincount(group, weights=gain, minlength=n_topics)
+    measures.append(('ndcg', np.where(ideal > 0, dcg / np.where(ideal > 0, ideal, 1), 0)))
+
+    # Interpolated precision at a recall level is the maximum precision at any rank where the
+    # recall is at least that level. Offsetting each topic by 2 lets one accumulate over the
+    # reversed rows compute the suffix maximum of every topic at once.
+    rel_group = group[relevant]
+    rel_precision = precision[relevant]
+    rel_recall = rel_so_far[relevant] / safe_num_rel[rel_group]
+    offset = 2.0 * (n_topics - rel_group)
+    interpolated = (np.maximum.accumulate((rel_precision + offset)[::-1])[::-1]) - offset
+    for level in RECALL_LEVELS:
+        measures.append(('iprec_at_recall_{:.2f}'.format(level), _group_max(
+            np.where(rel_recall >= level, interpolated, 0), rel_group, n_topics)))
+
+    for cutoff in cutoffs:
+        at_cutoff = np.bincount(group, weights=relevant & (rank <= cutoff), minlength=n_topics)
+        measures.append(('P_{}'.format(cutoff), at_cutoff / cutoff))
+    for cutoff in cutoffs:
+        at_cutoff = np.bincount(group, weights=relevant & (rank <= cutoff), minlength=n_topics)
+        measures.append(('recall_{}'.format(cutoff), at_cutoff / safe_num_rel))
+
+    queries = {topic: {} for topic in topics}
+    for measure, values in measures:
+        for topic, value in zip(topics, values.tolist()):
+            queries[topic][measure] = value
+    return _summarise(run_id, queries, [measure for measure, _ in measures])
+
+
+def _summarise(run_id: str, queries: Dict[str, Dict[str, float]],
+               measures: Sequence[str]) -> TrecEvalResults:
+    """
+    Accumulate the measures of each topic over all topics.
+    """
+    results = {'num_q': len(queries)}
+    for measure in measures:
+        values = np.array([values[measure] for values in queries.values()], dtype=np.float64)
+        if measure in SUMMED_MEASURES:
+            results[measure] = int(values.sum())
+        else:
+            results[measure] = float(values.mean()) if len(values) else 0.0
+    return TrecEvalResults(run_id, results, queries)
+
+
+class IncrementalEvaluator(object):
+    """
+    Evaluate a run as its rows arrive, such as rows written by a retrieval service, rather than
+    after the whole run is written. Rows are pushed one at a time (or fed from an iterator); the
+    rows of the current topic are buffered, and when a row of another topic arrives the
+    current topic is complete and is evaluated with evaluate. Only the measures of completed
+    topics are kept, so memory is bounded by the ranking of one topic. The rows of a topic must
+    therefore be contiguous.
+
+    >>> from irkit.trec import qrels
+    >>> from irkit.trec.run import TrecEvalRun
+    >>> evaluator = IncrementalEvaluator(qrels.loads('1 0 D1 1\\n2 0 D2 1'))
+    >>> evaluator.push(TrecEvalRun('1', 0, 'D1', 1, 2.0, 'live'))
+    >>> evaluator.push(TrecEvalRun('1', 0, 'D3', 2, 1.0, 'live'))
+    >>> topic, measures = evaluator.push(TrecEvalRun('2', 0, 'D3', 1, 1.0, 'live'))
+    >>> topic, measures['map'], measures['P_5']
+    ('1', 1.0, 0.2)
+    >>> evaluator.snapshot().results['num_q'], evaluator.snapshot(partial=True).results['map']
+    (1, 0.5)
+    >>> evaluator.flush()[0], evaluator.snapshot().results['num_q']
+    ('2', 2)
+    """
+
+    def __init__(self, qrels: Qrels, cutoffs: Sequence[int] = DEFAULT_CUTOFFS,
+                 relevance_level: int = 1, run_id: str = None):
+        """
+        :param qrels: The relevance judgements
+        :param cutoffs: Ranks at which to compute precision and recall
+        :param relevance_level: Minimum relevancy for a document to be considered relevant
+        :param run_id: The run id of the results (defaults to the run id of the first row)
+        """
+        self.qrels = qrels
+        self.cutoffs = cutoffs
+        self.relevance_level = relevance_level
+        self.run_id = run_id
+        self.queries = OrderedDict()
+        self._seen = set()
+        self._topic = None
+        self._rows = ColumnBuilder(TrecEvalRuns)
+
+    def _evaluate(self, runs: TrecEvalRuns) -> TrecEvalResults:
+        return evaluate(self.qrels, runs, self.cutoffs, self.relevance_level, self.run_id or '')
+
+    def push(self, row: TrecEvalRun) -> Optional[Tuple[str, Dict[str, float]]]:
+        """
+        Add a row of the run.
+
+        :param row: A TrecEvalRun
+        :return: The topic and measures of the topic completed by this row, if it completed one
+                 which is in the qrels
+        """
+        if self.run_id is None:
+            self.run_id = row.run_id
+        topic = str(row.topic)
+        completed = None
+        if topic != self._topic:
+            if topic in self._seen:
+                raise ValueError('Topic {} appears again after other topics; the rows of a '
+                                 'topic must be contiguous'.format(topic))
+            completed = self.flush()
+            self._topic = topic
+            self._seen.add(topic)
+        self._rows.append(topic, row.q, row.doc_id, row.rank, row.score, row.run_id)
+        return completed
+
+    def feed(self, rows: Iterable[TrecEvalRun]) -> Iterator[Tuple[str, Dict[str, float]]]:
+        """
+        Push every row of an iterator, yielding each topic as soon as it is complete. The last
+        topic is completed when the iterator is exhausted.
+
+        :param rows: An iterable of TrecEvalRun, such as irkit.trec.run.iter_load(fp)
+        :return: An iterator of the topic and measures of each completed topic
+        """
+        for row in rows:
+            completed = self.push(row)
+            if completed is not None:
+                yield completed
+        completed = self.flush()
+        if completed is not None:
+            yield completed
+
+    def flush(self) -> Optional[Tuple[str, Dict[str, float]]]:
+        """
+        Complete the current topic, for instance when the run has ended.
+
+        :return: The topic and its measures, or None if there is no current topic or it is not
+                 in the qrels
+        """
+        if not len(self._rows):
+            return None
+        topic = self._topic
+        results = self._evaluate(self._rows.build())
+        self._rows = ColumnBuilder(TrecEvalRuns)
+        if topic not in results.queries:
+            return None
+        self.queries[topic] = results.queries[topic]
+        return topic, results.queries[topic]
+
+    def snapshot(self, partial: bool = False) -> TrecEvalResults:
+        """
+        The results of the topics completed so far.
+
+        :param partial: Also include the current topic, evaluated with the rows received so far
+        :return: TrecEvalResults
+        """
+        queries = OrderedDict(self.queries)
+        if partial and len(self._rows):
+            queries.update(self._evaluate(self._rows.build()).queries)
+        if not queries:
+            return self._evaluate(TrecEvalRuns())
+        return _summarise(self.run_id or '', queries, list(next(iter(queries.values()))))
@@ -0,0 +1,239 @@
+"""
+Fuse several runs into one. For each topic the rows of every run are joined on their document ids
+with numpy: the document ids of the topic are encoded into codes with np.unique, and the fused
+score of each document is a bincount of the (normalised) scores or reciprocal ranks of its rows,
+so no per-document python dicts are built. Fusion works one topic at a time, and iter_fuse fuses
+streams of topics (such as run.iter_load(fp, by_topic=True)), so only one topic of each run is
+held in memory.
+
+The fusion methods are:
+
+- ``combsum``: the sum of the normalised scores of a document
+- ``combmnz``: combsum multiplied by the number of runs which retrieved the document
+- ``rrf``: reciprocal rank fusion, the sum of 1 / (k + rank) (scores are not normalised)
+
+Ranks are positions in trec_eval order (decreasing score, ties broken by decreasing document id),
+and the fused runs are ranked in the same order.
+
+Usage:
+
+>>> from irkit.trec import run
+>>> a = run.loads('1 0 D1 1 3 a\\n1 0 D2 2 2 a\\n1 0 D3 3 1 a')
+>>> b = run.loads('1 0 D3 1 10 b\\n1 0 D1 2 6 b\\n1 0 D4 3 2 b')
+>>> fused = fuse([a, b], 'combsum', run_id='fused')
+>>> fused.doc_id.tolist(), fused.score
+(['D1', 'D3', 'D2', 'D4'], array([1.5, 1. , 0.5, 0. ]))
+>>> fuse([a, b], 'combmnz').score
+array([3. , 2. , 0.5, 0. ])
+>>> fuse([a, b], 'rrf', k=1).doc_id.tolist()
+['D1', 'D3', 'D2', 'D4']
+"""
+import numpy as np
+from typing import Iterable, Iterator, List, Sequence
+
+from irkit.trec.run import TrecEvalRuns
+
+METHODS = ('combsum', 'combmnz', 'rrf')
+NORMALISATIONS = ('minmax', 'zscore')
+
+
+def normalise(scores: np.ndarray, normalisation: str = 'minmax') -> np.ndarray:
+    """
+    Normalise the scores of one topic of a run.
+
+    >>> normalise(np.array([4., 2., 0.]), 'minmax')
+    array([1. , 0.5, 0. ])
+    >>> normalise(np.array([4., 2., 0.]), 'zscore')
+    array([ 1.22474487,  0.        , -1.22474487])
+
+    :param scores: The scores
+    :param normalisation: minmax (scale to [0, 1], or 1 if the scores are equal), zscore
+                          (subtract the mean and divide by the standard deviation), or None
+    :return: The normalised scores
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    if normalisation is None or len(scores) == 0:
+        return scores
+    if normalisation == 'minmax':
+        low, high = scores.min(), scores.max()
+        if high == low:
+            return np.ones(len(scores))
+        return (scores - low) / (high - low)
+    if normalisation == 'zscore':
+        deviation = scores.std()
+        if deviation == 0:
+            return np.zeros(len(scores))
+        return (scores - scores.mean()) / deviation
+    raise ValueError('Unknown normalisation {}'.format(normalisation))
+
+
+def _fuse_topic(groups: Sequence[TrecEvalRuns], method: str, normalisation: str,
+                k: float, weights: Sequence[float], depth: int):
+    """
+    Fuse the rows of one topic of each run.
+
+    :return: The fused document ids (an object array) and their scores, in rank order
+    """
+    docs = [group._table('doc_id')[group._columns['doc_id']] for group in groups]
+    if not docs or sum(len(d) for d in docs) == 0:
+        return np.empty(0, dtype=object), np.zeros(0)
+    table, inverse = np.unique(np.concatenate(docs), return_inverse=True)
+    inverse = inverse.ravel()
+
+    contributions = []
+    start = 0
+    for group, group_docs, weight in zip(groups, docs, weights):
+        codes = inverse[start:start + len(group_docs)]
+        start += len(group_docs)
+        scores = group._columns['score']
+        if method == 'rrf':
+            # Codes are in sorted order of document id, so they break ties like trec_eval does.
+            order = np.lexsort((-codes, -scores))
+            ranks = np.empty(len(order))
+            ranks[order] = np.arange(1, len(order) + 1)
+            contributions.append(weight / (k + ranks))
+        else:
+            contributions.append(weight * normalise(scores, normalisation))
+    fused = np.bincount(inverse, weights=np.concatenate(contributions), minlength=len(table))
+    if method == 'combmnz':
+        fused *= np.bincount(inverse, minlength=len(table))
+
+    order = np.lexsort((-np.arange(len(table)), -fused))
+    if depth is not None:
+        order = order[:depth]
+    return table[order], fused[order]
+
+
+def _build(topics: List[str], docs: List[np.ndarray], scores: List[np.ndarray],
+           run_id: str) -> TrecEvalRuns:
+    """
+    Build runs from the fused documents and scores of each topic.
+    """
+    sizes = [len(d) for d in docs]
+    total = sum(sizes)
+    if total:
+        doc_table, doc_codes = np.unique(np.concatenate(docs), return_inverse=True)
+    else:
+        doc_table, doc_codes = np.empty(0, dtype=object), np.zeros(0, dtype=np.int64)
+    topics = [topic for topic, size in zip(topics, sizes) if size]
+    tables = {'topic': topics, 'q': ['0'], 'doc_id': doc_table.tolist(), 'run_id': [run_id]}
+    columns = {
+        'topic': np.repeat(np.arange(len(topics), dtype=np.int32), [s for s in sizes if s]),
+        'q': np.zeros(total, dtype=np.int32),
+        'doc_id': doc_codes.ravel().astype(np.int32),
+        'rank': np.concatenate([np.arange(1, s + 1, dtype=np.int32) for s in sizes])
+        if total else np.zeros(0, dtype=np.int32),
+        'score': np.concatenate(scores) if total else np.zeros(0),
+        'run_id': np.zeros(total, dtype=np.int32),
+    }
+    return TrecEvalRuns.from_columns(tables, columns)
+
+
+def _check(method: str, weights: Sequence[float], n: int) -> Sequence[float]:
+    if method not in METHODS:
+        raise ValueError('Unknown fusion method {}'.format(method))
+    if weights is None:
+        return [1.0] * n
+    if len(weights) != n:
+        raise ValueError('Expected a weight for each of the {} runs'.format(n))
+    return weights
+
+
+def fuse(runs: Sequence[TrecEvalRuns], method: str = 'combsum', normalisation: str = 'minmax',
+         k: float = 60, weights: Sequence[float] = None, depth: int = None,
+         run_id: str = 'fusion') -> TrecEvalRuns:
+    """
+    Fuse runs. Every topic of any of the runs is fused, in order of first appearance.
+
+    :param runs: The runs to fuse
+    :param method: combsum, combmnz or rrf
+    :param normalisation: The normalisation of the scores of each run and topic for combsum and
+                          combmnz (minmax, zscore, or None)
+    :param k: The constant of reciprocal rank fusion
+    :param weights: A weight multiplying the contributions of each run (defaults to 1 for all)
+    :param depth: The number of documents to keep for each topic (defaults to all)
+    :param run_id: The run id of the fused runs
+    :return: The fused runs
+    """
+    weights = _check(method, weights, len(runs))
+    topics = list(dict.fromkeys(topic for r in runs for topic in r.topics()))
+    docs, scores = [], []
+    for topic in topics:
+        topic_docs, topic_scores = _fuse_topic([r._topic_rows(topic) for r in runs],
+                                               method, normalisation, k, weights, depth)
+        docs.append(topic_docs)
+        scores.append(topic_scores)
+    return _build(topics, docs, scores, run_id)
+
+
+def iter_fuse(streams: Sequence[Iterable[TrecEvalRuns]], method: str = 'combsum',
+              normalisation: str = 'minmax', k: float = 60, weights: Sequence[float] = None,
+              depth: int = None, run_id: str = 'fusion',
+              topics: Sequence[str] = None) -> Iterator[TrecEvalRuns]:
+    """
+    Fuse streams of topics, yielding the fused runs of each topic as soon as every stream has
+    moved past it. Each stream yields the runs of one topic at a time. Without topics, every
+    stream must list the same topics in the same order, and a ValueError is raised as soon as the
+    heads of the streams disagree, before their topic is fused. When streams leave topics out,
+    pass the order of all the topics instead: each topic is fused once the head of no stream
+    comes before it, and a stream which goes back in the order raises a ValueError.
+
+    >>> import io
+    >>> from irkit.trec import run
+    >>> def streams():
+    ...     return [run.iter_load(io.StringIO('1 0 D1 1 2 a\\n1 0 D2 2 1 a\\n2 0 D1 1 1 a'), True),
+    ...             run.iter_load(io.StringIO('2 0 D2 1 1 b'), True)]
+    >>> [fused.doc_id.tolist() for fused in iter_fuse(streams(), 'combmnz', topics=['1', '2'])]
+    [['D1', 'D2'], ['D2', 'D1']]
+    >>> list(iter_fuse(streams()))
+    Traceback (most recent call last):
+    ...
+    ValueError: Streams are at topics 1 and 2; pass topics if streams leave topics out
+
+    :param streams: An iterable of single topic TrecEvalRuns for each run
+    :param method: combsum, combmnz or rrf
+    :param normalisation: minmax, zscore, or None (see fuse)
+    :param k: The constant of reciprocal rank fusion
+    :param weights: A weight multiplying the contributions of each run (defaults to 1 for all)
+    :param depth: The number of documents to keep for each topic (defaults to all)
+    :param run_id: The run id of the fused runs
+    :param topics: The order of the topics of all the streams, if streams leave topics out
+    :return: An iterator of the fused TrecEvalRuns of each topic
+    """
+    weights = _check(method, weights, len(streams))
+    streams = [iter(stream) for stream in streams]
+    heads = [next(stream, None) for stream in streams]
+    positions = None if topics is None else {str(t): i for i, t in enumerate(topics)}
+    fused_topics = set()
+    while any(head is not None for head in heads):
+        head_topics = [None if head is None else head.topics()[0] for head in heads]
+        if positions is None:
+            topic = next(t for t in head_topics if t is not None)
+            for other in head_topics:
+                if other != topic:
+                    raise ValueError('Streams are at topics {} and {}; pass topics if streams '
+                                     'leave topics out'.format(topic, other))
+            if topic in fused_topics:
+                raise ValueError('Topic {} appears again; the streams must list their topics '
+                                 'in the same order'.format(topic))
+            fused_topics.add(topic)
+        else:
+            for i, other in enumerate(head_topics):
+                if other is not None and other not in positions:
+                    raise ValueError('Topic {} of stream {} is not in topics'.format(other, i))
+            topic = min((t for t in head_topics if t is not None), key=positions.__getitem__)
+        groups = []
+        for i, head in enumerate(heads):
+            if head_topics[i] == topic:
+                groups.append(head)
+                heads[i] = next(streams[i], None)
+                if positions is not None and heads[i] is not None:
+                    following = heads[i].topics()[0]
+                    if positions.get(following, len(positions)) <= positions[topic]:
+                        raise ValueError('Topic {} follows topic {} in stream {}, against the '
+                                         'order of topics'.format(following, topic, i))
+            else:
+                groups.append(TrecEvalRuns())
+        docs, scores = _fuse_topic(groups, method, normalisation, k, weights, depth)
+        if len(docs):
+            yield _build([topic], [docs], [scores], run_id)
@@ -7,7 +7,9 @@ Usage:
 >>> sample_qrels = '1 0 AP880212-0161 0\\n1 0 AP880216-0139 1\\n1 0 AP880216-0169 0'
 >>> qrels = loads(sample_qrels)
 >>> qrels.topic
-['1', '1', '1']
+array(['1', '1', '1'], dtype=object)
+>>> qrels.relevancy
+array([0, 1, 0], dtype=int32)
 >>> [x.topic for x in qrels['1']]
 ['1', '1', '1']
 
@@ -18,15 +20,26 @@ Mar 2017
 import io
 
 import os
-from typing import List
+import numpy as np
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple, Union
+
+import irkit.trec.binary
+import irkit.trec.shards
+from irkit.instrument import instrumented
+from irkit.trec.columns import ITER_CHUNK_SIZE, ColumnBuilder, Columns, iter_groups, \
+    parse_bulk, read_chunks, split_lines
 
 
 class Qrel:
     """
     A line in a qrels file conforming to the specification at:
     http://trec.nist.gov/data/qrels_eng/
+
+    The fields are declared in __slots__, so a Qrel has no instance dictionary.
     """
 
+    __slots__ = ('topic', 'iteration', 'document_num', 'relevancy')
+
     def __init__(self, topic: str, iteration: int, document_num: str, relevancy: int):
         self.topic = topic
         self.iteration = iteration
@@ -38,40 +51,156 @@ class Qrel:
                                     self.document_num, self.relevancy)
 
 
-class Qrels:
+class Qrels(Columns):
     """
-    A python representation of a qrels file. It is a list of Qrel objects.
+    A python representation of a qrels file. The lines are stored column-wise: topics and
+    document numbers are interned into string tables, iteration and relevancy are numpy arrays,
+    and Qrel objects are only created when iterating. Rows are grouped by topic, and an index
+    from topic to rows is built at load time. The relevancy of a (topic, document_num) pair is
+    looked up with relevance, or for every row of some runs at once with annotate.
     """
 
-    def __init__(self, qrels: List[Qrel]):
-        self.qrels = qrels
+    _row_type = Qrel
+    _fields = ('topic', 'iteration', 'document_num', 'relevancy')
+    _string_fields = ('topic', 'document_num')
+    _numeric_fields = {'iteration': np.int32, 'relevancy': np.int32}
+    _document_field = 'document_num'
+    _line_format = '{} {} {} {}'
+
+    def __init__(self, qrels: Iterable[Qrel] = ()):
+        super().__init__(qrels)
+
+    def _assign(self, tables: Dict[str, List[str]], columns: Dict[str, np.ndarray],
+                index: Dict[str, slice] = None) -> None:
+        super()._assign(tables, columns, index)
+        self._judgements = None
+
+    def _judgement_index(self) -> Tuple[Dict[str, int], Dict[str, int], int, np.ndarray,
+                                        np.ndarray]:
+        """
+        The index used to look up relevancy, built the first time it is needed: hash tables from
+        each topic and document number to its code, and the relevancy of each judged pair keyed
+        by topic code * number of documents + document code, sorted by key. The first judgement
+        of a pair which is judged more than once is kept.
+        """
+        if self._judgements is None:
+            topics = {topic: code for code, topic in enumerate(self._tables['topic'])}
+            docs = {doc: code for code, doc in enumerate(self._tables['document_num'])}
+            n_docs = max(len(docs), 1)
+            keys = self._columns['topic'].astype(np.int64) * n_docs + \
+                self._columns['document_num']
+            order = np.argsort(keys, kind='stable')
+            keys = keys[order]
+            first = np.concatenate(([True], keys[1:] != keys[:-1])) if len(keys) else \
+                np.zeros(0, dtype=bool)
+            self._judgements = (topics, docs, n_docs, keys[first],
+                                self._columns['relevancy'][order][first])
+        return self._judgements
+
+    def relevance(self, topic, document_num: str, default: int = 0) -> int:
+        """
+        Look up the relevancy of a document for a topic.
+
+        >>> qrels = loads('1 0 D1 2\\n1 0 D2 0\\n2 0 D1 1')
+        >>> qrels.relevance('1', 'D1'), qrels.relevance(2, 'D1'), qrels.relevance('2', 'D2')
+        (2, 1, 0)
+
+        :param topic: The topic
+        :param document_num: The document
+        :param default: The relevancy of a document which is not judged for the topic
+        :return: The relevancy
+        """
+        topics, docs, n_docs, keys, relevancy = self._judgement_index()
+        topic_code, doc_code = topics.get(str(topic)), docs.get(document_num)
+        if topic_code is None or doc_code is None:
+            return default
+        key = topic_code * n_docs + doc_code
+        found = np.searchsorted(keys, key)
+        if found < len(keys) and keys[found] == key:
+            return int(relevancy[found])
+        return default
+
+    def annotate(self, runs: 'irkit.trec.run.TrecEvalRuns', default: int = 0) -> np.ndarray:
+        """
+        Look up the relevancy of every row of some runs in one pass. The topics and documents of
+        the runs are translated once per distinct value through the hash tables of the index,
+        and the rows are then joined with the judgements by a vectorized binary search.
+
+        >>> from irkit.trec import run
+        >>> qrels = loads('1 0 D1 2\\n1 0 D2 0\\n2 0 D1 1')
+        >>> qrels.annotate(run.loads('1 0 D1 1 2 r\\n1 0 D3 2 1 r\\n2 0 D1 1 1 r'))
+        array([2, 0, 1], dtype=int32)
+
+        :param runs: TrecEvalRuns
+        :param default: The relevancy of documents which are not judged for their topic
+        :return: The relevancy of each row of the runs, in the order of the rows
+        """
+        topics, docs, n_docs, keys, relevancy = self._judgement_index()
+        topic_codes = np.array([topics.get(topic, -1) for topic in runs._tables['topic']],
+                               dtype=np.int64)[runs._columns['topic']]
+        doc_codes = np.array([docs.get(doc, -1) for doc in runs._tables['doc_id']],
+                             dtype=np.int64)[runs._columns['doc_id']]
+        annotated = np.full(len(topic_codes), default, dtype=np.int32)
+        if len(keys) == 0:
+            return annotated
+        run_keys = topic_codes * n_docs + doc_codes
+        found = np.minimum(np.searchsorted(keys, run_keys), len(keys) - 1)
+        judged = (topic_codes >= 0) & (doc_codes >= 0) & (keys[found] == run_keys)
+        annotated[judged] = relevancy[found[judged]]
+        return annotated
+
+    @property
+    def qrels(self) -> Tuple[Qrel, ...]:
+        """
+        The qrels as Qrel objects. Each access builds every row from the columns, so the result
+        is a tuple: it is a snapshot which cannot be appended to. Assign to qrels to replace the
+        rows, and use row (or iterate) rather than indexing qrels repeatedly.
+
+        :return: The qrels as a tuple of Qrel objects.
+        """
+        return tuple(self)
+
+    @qrels.setter
+    def qrels(self, qrels: Iterable[Qrel]):
+        other = Qrels(qrels)
+        self._assign(other._tables, other._columns, other._index)
 
     def __getattr__(self, field):
         """
-        Access a column of the qrels by accessing the fields in a Qrel.
+        Access a column of the qrels. The iteration and relevancy columns are views of the
+        underlying arrays, the other columns are decoded from their string tables.
         
         :param field: One of the attributes (fields) of the qrel
         :return: The column for the field (i.e. only the topics, or only the document_num)
         """
-        return [x.__getattribute__(field) for x in self.qrels]
+        return super().__getattr__(field)
 
     def __setitem__(self, key, value):
         raise Exception('Cannot set qrel values')
 
     def __delattr__(self, topic):
-        self.qrels = [x for x in self.qrels if x.topic != topic]
+        self._drop_topic(topic)
 
-    def __getitem__(self, topic):
+    def __getitem__(self, topic) -> 'Qrels':
         """
-        Allow qrels to be indexed by topic id.
-        
+        Allow qrels to be indexed by topic id. This is a lookup in the topic index, and the
+        columns of the result are views of the columns of these qrels. The result is a Qrels (it
+        used to be a list of rows), so it is iterated over to get its rows, and row gets one by
+        its position. Numbers are looked up as topic ids, never as positions, and slicing raises
+        a TypeError.
+
+        >>> qrels = loads('1 0 D1 0\\n1 0 D2 1')
+        >>> qrels[1].row(-1).document_num
+        'D2'
+        >>> qrels['1'][:1]
+        Traceback (most recent call last):
+        ...
+        TypeError: Rows are indexed by topic, not sliced; use row() or iterate
+
         :param topic: The topic
         :return: The rows of this topic
         """
-        return [x for x in self.qrels if x.topic == topic]
-
-    def __str__(self):
-        return os.linesep.join([str(x) for x in self.qrels])
+        return self._topic_rows(topic)
 
     def dumps(self) -> str:
         """
@@ -81,35 +210,97 @@ class Qrels:
         """
         return str(self)
 
-    def dump(self, fp: io.TextIOWrapper) -> None:
+    def dump(self, fp: io.TextIOWrapper, chunk_size: int = ITER_CHUNK_SIZE) -> None:
         """
-        Dump the qrels to a file
+        Dump the qrels to a file. Rows are formatted and written a chunk at a time, so the whole
+        file is never held in memory. Use dump_file to write a gzip file.
         
         :param fp: A File pointer
+        :param chunk_size: The number of rows formatted and written at a time
         """
-        fp.writelines(self.dumps())
+        self._write(fp, chunk_size)
 
 
-def loads(qrels: str) -> Qrels:
+@instrumented()
+def loads(qrels: str, fast: bool = False) -> Qrels:
     """
-    Load qrels from a string.
+    Load qrels from a string. The rows are grouped by topic: when the topics of the lines are
+    interleaved, the rows of each topic are moved together (keeping topics in order of first
+    appearance and rows in order within a topic), so iterating and dumping give that order.
+
+    >>> loads('1 0 D1 1\\n2 0 D2 0\\n1 0 D3 0').document_num
+    array(['D1', 'D3', 'D2'], dtype=object)
     
     :param qrels: Some string representation of qrels
+    :param fast: Use the bulk tokenizer (see irkit.trec.columns.parse_bulk), which requires
+                 every line to have exactly four fields.
     :return: Qrels object
     """
-    data = []
-    for line in qrels.split(os.linesep):
-        if len(line.split()) > 0:
-            topic, iteration, document_num, relevancy = line.split()
-            data.append(Qrel(topic, int(iteration), document_num, int(relevancy)))
-    return Qrels(data)
+    if fast:
+        return parse_bulk(Qrels, [qrels])
+    return ColumnBuilder(Qrels).extend(split_lines(qrels.split(os.linesep))).build()
 
 
-def load(qrels: io.TextIOWrapper) -> Qrels:
+@instrumented()
+def load(qrels: io.TextIOWrapper, fast: bool = False) -> Qrels:
     """
-    Load qrels from a file.
+    Load qrels from a file. As with loads, the rows are grouped by topic, so a file whose
+    topics are interleaved is not dumped back in the same order.
     
     :param qrels: File pointer
+    :param fast: Use the bulk tokenizer (see irkit.trec.columns.parse_bulk), which requires
+                 every line to have exactly four fields.
     :return: Qrels object
     """
-    return loads(os.linesep.join(qrels.readlines()))
+    if fast:
+        return parse_bulk(Qrels, read_chunks(qrels))
+    return ColumnBuilder(Qrels).extend(split_lines(qrels)).build()
+
+
+@instrumented()
+def load_cached(path: str, cache_path: str = None) -> Qrels:
+    """
+    Load qrels through a binary cache. If the cache is at least as new as the file it is
+    memory-mapped, otherwise the file is parsed and the cache is written for next time.
+
+    :param path: Path of the text file
+    :param cache_path: Path of the binary cache (defaults to the path with the suffix
+                       irkit.trec.binary.CACHE_SUFFIX)
+    :return: Qrels
+    """
+    return irkit.trec.binary.load_cached(Qrels, path, load, cache_path)
+
+
+@instrumented()
+def load_shards(paths: Union[str, Sequence[str]], processes: int = None, fast: bool = False,
+                deduplicate: bool = True) -> Qrels:
+    """
+    Load qrels which are split into several shards (which may be gzip compressed), parsing the
+    shards in parallel worker processes and merging them (see irkit.trec.shards).
+
+    :param paths: A glob or path, or a list of them
+    :param processes: Number of worker processes (defaults to the number of CPUs)
+    :param fast: Parse the shards with the bulk tokenizer
+    :param deduplicate: Only keep the first row of each (topic, document) pair
+    :return: Qrels
+    """
+    return irkit.trec.shards.load(Qrels, paths, load, processes, fast, deduplicate)
+
+
+def iter_load(qrels: io.TextIOWrapper, by_topic: bool = False) -> Iterator[Union[Qrel, Qrels]]:
+    """
+    Lazily load qrels, parsing one line at a time from the file pointer.
+
+    >>> [str(qrel) for qrel in iter_load(io.StringIO('1 0 AP880212-0161 0\\n2 0 AP880216-0139 1'))]
+    ['1 0 AP880212-0161 0', '2 0 AP880216-0139 1']
+
+    :param qrels: File pointer
+    :param by_topic: Yield a Qrels for each topic instead of each Qrel. Only the lines of one
+                     topic are kept in memory, so the file should be sorted by topic.
+    :return: An iterator of Qrel or Qrels
+    """
+    if by_topic:
+        yield from iter_groups(Qrels, split_lines(qrels))
+    else:
+        for topic, iteration, document_num, relevancy in split_lines(qrels):
+            yield Qrel(topic, int(iteration), document_num, int(relevancy))
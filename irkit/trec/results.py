@@ -1,18 +1,40 @@
 """
 Functions and classes for dealing with trec_eval results files.
 
+Usage:
+
+>>> results = loads('map 1 0.5\\nP_5 1 0.4\\nmap 2 0.25\\nP_5 2 0.2\\nmap all 0.375')
+>>> results.results['map']
+0.375
+>>> results.column('map')
+array([0.5 , 0.25])
+>>> results.matrix[results.query_index['2']]
+array([0.25, 0.2 ])
+
 Harry Scells
 Mar 2017
 """
 import io
 
 import os
-from typing import Dict
+import numpy as np
+from collections import OrderedDict
+from typing import Dict, Iterable, Iterator, Sequence, Tuple, Union
+
+from irkit.instrument import instrumented
 
 
 class TrecEvalResults:
     """
-    An object that stores the results output by trec_eval.
+    An object that stores the results output by trec_eval. Besides the per-query dictionaries in
+    queries, the per-query values are stored in a dense float matrix with a row for each query and
+    a column for each measure (NaN where a query has no value for a measure), which is built once
+    when the object is created:
+
+    - ``query_ids``: the queries, in the order of the rows, as a numpy string array
+    - ``measures``: the measures, in the order of the columns
+    - ``query_index`` and ``measure_index``: the row of each query and the column of each measure
+    - ``matrix``: the values
     """
 
     def __init__(self, run_id: str, results: Dict, queries: Dict):
@@ -20,6 +42,31 @@ class TrecEvalResults:
         self.results = results
         self.queries = queries
 
+        self.query_index = OrderedDict((query, i) for i, query in enumerate(queries))
+        self.measure_index = OrderedDict()
+        for values in queries.values():
+            for measure in values:
+                if measure not in self.measure_index:
+                    self.measure_index[measure] = len(self.measure_index)
+        self.query_ids = np.array(list(self.query_index), dtype=str)
+        self.measures = list(self.measure_index)
+        self.matrix = np.full((len(self.query_index), len(self.measure_index)), np.nan)
+        for row, values in zip(self.matrix, queries.values()):
+            if list(values) == self.measures:
+                row[:] = list(values.values())
+            else:
+                for measure, value in values.items():
+                    row[self.measure_index[measure]] = value
+
+    def column(self, measure: str) -> np.ndarray:
+        """
+        The values of a measure for every query, in the order of query_ids.
+
+        :param measure: The name of the measure, e.g. map
+        :return: A view of a column of the matrix
+        """
+        return self.matrix[:, self.measure_index[measure]]
+
     def __getitem__(self, query):
         """
         Allow trec results to be indexed by query num.
@@ -29,7 +76,68 @@ class TrecEvalResults:
         """
         return self.queries[query]
 
+    def __str__(self):
+        lines = []
+        for query, measures in self.queries.items():
+            for field, value in measures.items():
+                lines.append('{}\t{}\t{}'.format(field, query, _format_value(field, value)))
+        lines.append('runid\tall\t{}'.format(self.run_id))
+        for field, value in self.results.items():
+            lines.append('{}\tall\t{}'.format(field, _format_value(field, value)))
+        return os.linesep.join(lines)
+
+    def dumps(self) -> str:
+        """
+        Dump the results to a string in the format of trec_eval -q.
+
+        :return: Formatted results
+        """
+        return str(self)
+
+    def dump(self, fp: io.TextIOWrapper) -> None:
+        """
+        Dump the results to a file
+
+        :param fp: A File pointer
+        """
+        fp.writelines(self.dumps())
+
+
+def _format_value(field: str, value) -> str:
+    if isinstance(value, str):
+        return value
+    if field.startswith('num_'):
+        return str(int(value))
+    return '{:.4f}'.format(value)
+
+
+def aligned(results: Sequence[TrecEvalResults], measure: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Align the values of a measure across several results, over the queries which all of them
+    contain. The queries are matched with numpy set operations rather than by query.
+
+    >>> a = loads('map 1 0.5\\nmap 2 0.25\\nmap 3 0.1')
+    >>> b = loads('map 3 0.3\\nmap 1 0.4')
+    >>> aligned([a, b], 'map')
+    (array(['1', '3'], dtype='<U1'), array([[0.5, 0.1],
+           [0.4, 0.3]]))
+
+    :param results: The results to align
+    :param measure: The name of the measure
+    :return: The common queries (sorted), and a matrix with a row of values for each results
+    """
+    common = results[0].query_ids if results else np.array([], dtype=str)
+    for other in results[1:]:
+        common = np.intersect1d(common, other.query_ids, assume_unique=True)
+    rows = []
+    for r in results:
+        _, _, positions = np.intersect1d(common, r.query_ids, assume_unique=True,
+                                         return_indices=True)
+        rows.append(r.column(measure)[positions])
+    return common, np.array(rows).reshape(len(results), len(common))
+
 
+@instrumented(count=lambda results, *args, **kwargs: len(results.queries), unit='queries')
 def loads(trec_results: str) -> TrecEvalResults:
     """
     Load trec_eval results from a string.
@@ -37,15 +145,39 @@ def loads(trec_results: str) -> TrecEvalResults:
     :param trec_results: Some string representation of trec results
     :return: TrecEvalResults object
     """
-    run_id = ''
-    results = {}
-    queries = {}
+    return _build(_iter_lines(trec_results.split(os.linesep)))
+
 
-    for line in trec_results.split(os.linesep):
+def _iter_lines(lines: Iterable[str]) -> Iterator[Tuple[str, str, Union[str, float]]]:
+    for line in lines:
         if not line.strip():
             continue
         field, query, value = line.split()
         if query == 'all':  # accumulated results over all queries
+            yield field, query, _parse_value(field, value)
+        else:
+            yield field, query, float(value)
+
+
+def _parse_value(field: str, value: str) -> Union[str, int, float]:
+    """
+    Convert a value accumulated over all queries to a number, if it is one.
+    """
+    if field == 'runid':
+        return value
+    try:
+        return int(value) if field.startswith('num_') else float(value)
+    except ValueError:
+        return value
+
+
+def _build(lines: Iterable[Tuple[str, str, Union[str, float]]]) -> TrecEvalResults:
+    run_id = ''
+    results = {}
+    queries = {}
+
+    for field, query, value in lines:
+        if query == 'all':
             if field == 'runid':
                 run_id = value
             else:
@@ -53,16 +185,49 @@ def loads(trec_results: str) -> TrecEvalResults:
         else:
             if query not in queries:
                 queries[query] = {}
-            queries[query][field] = float(value)
+            queries[query][field] = value
 
     return TrecEvalResults(run_id, results, queries)
 
 
+@instrumented(count=lambda results, *args, **kwargs: len(results.queries), unit='queries')
 def load(trec_result_file: io.TextIOWrapper) -> TrecEvalResults:
     """
     Load trec_eval results from a file.
     
     :param trec_result_file: File pointer
-    :return: Qrels object
+    :return: TrecEvalResults object
+    """
+    return _build(_iter_lines(trec_result_file))
+
+
+def iter_load(trec_result_file: io.TextIOWrapper, by_topic: bool = False) \
+        -> Iterator[Tuple]:
+    """
+    Lazily load trec_eval results, parsing one line at a time from the file pointer. Values are
+    converted to numbers (the num_* values accumulated over all queries to ints); the run id and
+    any other value which is not a number are left as strings.
+
+    >>> list(iter_load(io.StringIO('map 1 0.5\\nP_5 1 0.4\\nmap 2 0.25\\nmap all 0.375')))
+    [('map', '1', 0.5), ('P_5', '1', 0.4), ('map', '2', 0.25), ('map', 'all', 0.375)]
+    >>> list(iter_load(io.StringIO('map 1 0.5\\nP_5 1 0.4\\nmap 2 0.25'), by_topic=True))
+    [('1', {'map': 0.5, 'P_5': 0.4}), ('2', {'map': 0.25})]
+
+    :param trec_result_file: File pointer
+    :param by_topic: Yield a (query, {measure: value}) pair for each consecutive block of lines
+                     of a query instead of each (measure, query, value) line.
+    :return: An iterator of lines or per-query groups
     """
-    return loads(os.linesep.join(trec_result_file.readlines()))
+    lines = _iter_lines(trec_result_file)
+    if not by_topic:
+        yield from lines
+        return
+    query, values = None, {}
+    for field, line_query, value in lines:
+        if line_query != query and values:
+            yield query, values
+            values = {}
+        query = line_query
+        values[field] = value
+    if values:
+        yield query, values
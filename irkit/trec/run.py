@@ -7,15 +7,19 @@ Usage:
 >>> sample_run = '''351   0  DOC1  1   100   run-name\\n351   0  DOC2  2   50   run-name'''
 >>> runs = loads(sample_run)
 >>> runs.dumps()
-'351\tQ0\tDOC1\t1\t100\trun-name\n351\tQ0\tDOC2\t2\t50\trun-name'
+'351\\tQ0\\tDOC1\\t1\\t100\\trun-name\\n351\\tQ0\\tDOC2\\t2\\t50\\trun-name'
 >>> [str(run) for run in runs.runs]
-['351\tQ0\tDOC1\t1\t100\trun-name', '351\tQ0\tDOC2\t2\t50\trun-name']
+['351\\tQ0\\tDOC1\\t1\\t100\\trun-name', '351\\tQ0\\tDOC2\\t2\\t50\\trun-name']
+>>> runs.topics()
+['351']
 >>> [str(run) for run in runs['351']]
-['351\tQ0\tDOC1\t1\t100\trun-name', '351\tQ0\tDOC2\t2\t50\trun-name']
+['351\\tQ0\\tDOC1\\t1\\t100\\trun-name', '351\\tQ0\\tDOC2\\t2\\t50\\trun-name']
 >>> runs.rank
-['1', '2']
+array([1, 2], dtype=int32)
+>>> runs.score
+array([100.,  50.])
 >>> TrecEvalRuns(runs['351']).rank
-['1', '2']
+array([1, 2], dtype=int32)
 
 Harry Scells
 May 2017
@@ -23,14 +27,39 @@ May 2017
 import io
 
 import os
-from typing import List
+import numpy as np
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple, Union
+
+import irkit.trec.binary
+import irkit.trec.shards
+from irkit.instrument import instrumented
+from irkit.trec.columns import ITER_CHUNK_SIZE, ColumnBuilder, Columns, iter_groups, \
+    parse_bulk, read_chunks, split_lines
+
+
+def format_score(score) -> str:
+    """
+    Format a score for a run file. Integral scores are written without a trailing ``.0`` so that
+    a score read as ``100`` is written back as ``100``.
+
+    :param score: The score of a document
+    :return: The score as a string
+    """
+    if isinstance(score, (float, np.floating)):
+        score = repr(float(score))
+        if score.endswith('.0'):
+            score = score[:-2]
+    return str(score)
 
 
 class TrecEvalRun(object):
     """
-    TrecEvalRun is a container class for a line in a trec_eval run file.
+    TrecEvalRun is a container class for a line in a trec_eval run file. It uses __slots__ rather
+    than a per-instance __dict__ to keep the memory used by each row small.
     """
 
+    __slots__ = ('topic', 'q', 'doc_id', 'rank', 'score', 'run_id')
+
     def __init__(self, topic: str, q: int, doc_id: str, rank: int, score: float, run_id: str):
         self.topic = topic
         self.q = q
@@ -41,45 +70,219 @@ class TrecEvalRun(object):
 
     def __str__(self):
         return '{}\tQ{}\t{}\t{}\t{}\t{}'.format(self.topic, self.q, self.doc_id, self.rank,
-                                                self.score, self.run_id)
+                                                format_score(self.score), self.run_id)
+
+
+class RunReport(object):
+    """
+    The anomalies found in runs by TrecEvalRuns.normalise, by topic:
+
+    - ``unsorted``: topics whose rows are not in trec_eval order (decreasing score, ties broken by
+      decreasing document id)
+    - ``misranked``: topics whose rank column is not 1, 2, ... in trec_eval order
+    - ``ties``: the number of rows of a topic which share their score with another row
+    - ``duplicates``: the documents which appear more than once for a topic
+    - ``truncated``: the number of rows of a topic beyond the depth
+    - ``run_ids``: every run id, if the runs have more than one
+    """
+
+    def __init__(self, rows: int, topics: int, unsorted: List[str], misranked: List[str],
+                 ties: Dict[str, int], duplicates: Dict[str, List[str]],
+                 truncated: Dict[str, int], run_ids: List[str]):
+        self.rows = rows
+        self.topics = topics
+        self.unsorted = unsorted
+        self.misranked = misranked
+        self.ties = ties
+        self.duplicates = duplicates
+        self.truncated = truncated
+        self.run_ids = run_ids
+
+    @property
+    def ok(self) -> bool:
+        """
+        :return: Whether the runs are already normalised: sorted, ranked, without duplicate
+                 documents and within the depth. Tied scores alone are not an anomaly.
+        """
+        return not (self.unsorted or self.misranked or self.duplicates or self.truncated or
+                    self.run_ids)
 
+    def to_dict(self) -> dict:
+        """
+        :return: The report as a dict which can be serialised as JSON.
+        """
+        return {'rows': self.rows, 'topics': self.topics, 'unsorted': self.unsorted,
+                'misranked': self.misranked, 'ties': self.ties, 'duplicates': self.duplicates,
+                'truncated': self.truncated, 'run_ids': self.run_ids}
+
+    def __str__(self):
+        return '\n'.join('{}: {}'.format(key, value) for key, value in self.to_dict().items())
 
-class TrecEvalRuns(object):
+
+class TrecEvalRuns(Columns):
     """
-    TrecEvalRuns is a wrapper around a TrecEvalRun which is just a container class for a line in
-    a trec_eval run file. This class contains some convenience functions for dealing with runs, 
-    such as getting a list of the runs but topic id or slicing by column.
+    TrecEvalRuns is a column-oriented collection of the lines in a trec_eval run file. The topic,
+    q, doc_id and run_id fields are interned into string tables and stored as integer codes, and
+    the rank and score fields are stored as contiguous numpy arrays. TrecEvalRun objects are only
+    created when iterating over the runs. Rows are grouped by topic, and an index from topic to
+    rows is built at load time. This class contains some convenience functions for
+    dealing with runs, such as getting a list of the runs by topic id or slicing by column.
     """
 
-    def __init__(self, runs: List[TrecEvalRun]):
-        self.runs = runs
+    _row_type = TrecEvalRun
+    _fields = ('topic', 'q', 'doc_id', 'rank', 'score', 'run_id')
+    _string_fields = ('topic', 'q', 'doc_id', 'run_id')
+    _numeric_fields = {'rank': np.int32, 'score': np.float64}
+    _document_field = 'doc_id'
+    _line_format = '{}\tQ{}\t{}\t{}\t{}\t{}'
+
+    def __init__(self, runs: Iterable[TrecEvalRun] = ()):
+        super().__init__(runs)
+
+    @property
+    def runs(self) -> Tuple[TrecEvalRun, ...]:
+        """
+        The runs as TrecEvalRun objects. Each access builds every row from the columns, so the
+        result is a tuple: it is a snapshot which cannot be appended to. Assign to runs to
+        replace the rows, and use row (or iterate) rather than indexing runs repeatedly.
+
+        :return: The runs as a tuple of TrecEvalRun objects.
+        """
+        return tuple(self)
+
+    @runs.setter
+    def runs(self, runs: Iterable[TrecEvalRun]):
+        other = TrecEvalRuns(runs)
+        self._assign(other._tables, other._columns, other._index)
 
     def __getattr__(self, field):
         """
-        Access a column of the runs by accessing the fields in a run.
+        Access a column of the runs. The rank and score columns are views of the underlying
+        arrays, the other columns are decoded from their string tables.
         
-        :param field: One of the attributes (fields) of the qrel
-        :return: The column for the field (i.e. only the topics, or only the document_num)
+        :param field: One of the attributes (fields) of a run
+        :return: The column for the field (i.e. only the topics, or only the doc_ids)
         """
-        return [x.__getattribute__(field) for x in self.runs]
+        return super().__getattr__(field)
 
     def __setitem__(self, key, value):
         raise Exception('Cannot set run values')
 
     def __delattr__(self, topic):
-        self.runs = [x for x in self.runs if x.topic != topic]
+        self._drop_topic(topic)
 
-    def __getitem__(self, topic):
+    def __getitem__(self, topic) -> 'TrecEvalRuns':
         """
-        Allow runs to be indexed by topic id.
-        
+        Allow runs to be indexed by topic id. This is a lookup in the topic index, and the
+        columns of the result are views of the columns of these runs. The result is a
+        TrecEvalRuns (it used to be a list of rows), so it is iterated over to get its rows, and
+        row gets one by its position. Numbers are looked up as topic ids, never as positions,
+        and slicing raises a TypeError.
+
+        >>> runs = loads('351 0 DOC1 1 100 r\\n351 0 DOC2 2 50 r')
+        >>> runs[351].doc_id
+        array(['DOC1', 'DOC2'], dtype=object)
+        >>> runs['351'].row(0).doc_id
+        'DOC1'
+        >>> runs['351'][:1]
+        Traceback (most recent call last):
+        ...
+        TypeError: Rows are indexed by topic, not sliced; use row() or iterate
+
         :param topic: The topic
         :return: The rows of this topic
         """
-        return [x for x in self.runs if x.topic == topic]
+        return self._topic_rows(topic)
 
-    def __str__(self):
-        return os.linesep.join([str(run) for run in self.runs])
+    def _format_values(self, field: str, values: list) -> list:
+        if field == 'score':
+            return [format_score(score) for score in values]
+        return values
+
+    def normalise(self, depth: int = None,
+                  deduplicate: bool = True) -> Tuple['TrecEvalRuns', RunReport]:
+        """
+        Put each topic into the order trec_eval ranks it in (decreasing score, ties broken by
+        decreasing document id), renumber the ranks from 1, optionally drop repeated documents
+        (keeping the highest ranked) and truncate each topic to a depth. Everything is computed
+        for all topics at once with a single lexsort over the topic, score and document columns.
+
+        >>> runs = loads('1 0 D1 1 1 r\\n1 0 D2 1 3 r\\n1 0 D1 3 2 r\\n1 0 D3 4 3 r')
+        >>> normalised, report = runs.normalise(depth=2)
+        >>> normalised.doc_id.tolist(), normalised.rank
+        (['D3', 'D2'], array([1, 2], dtype=int32))
+        >>> report.unsorted, report.misranked, report.duplicates, report.truncated, report.ties
+        (['1'], ['1'], {'1': ['D1']}, {'1': 1}, {'1': 2})
+
+        :param depth: The number of rows to keep for each topic (defaults to all)
+        :param deduplicate: Drop the lower ranked rows of a document which appears more than
+                            once for a topic
+        :return: The normalised runs and a RunReport of the anomalies found
+        """
+        topics = list(self._index)
+        sizes = np.array([rows.stop - rows.start for rows in self._index.values()],
+                         dtype=np.int64)
+        group = np.repeat(np.arange(len(topics)), sizes)
+        docs = self._columns['doc_id']
+        scores = self._columns['score']
+        doc_order = np.empty(len(self._tables['doc_id']), dtype=np.int64)
+        doc_order[np.argsort(self._table('doc_id'), kind='stable')] = np.arange(len(doc_order))
+        order = np.lexsort((-doc_order[docs], -scores, group))
+        unsorted = np.bincount(group, weights=order != np.arange(len(order)),
+                               minlength=len(topics)) > 0
+
+        sorted_group, sorted_docs, sorted_scores = group[order], docs[order], scores[order]
+        same_score = (sorted_group[1:] == sorted_group[:-1]) & \
+            (sorted_scores[1:] == sorted_scores[:-1])
+        tied = np.zeros(len(order), dtype=bool)
+        tied[1:] |= same_score
+        tied[:-1] |= same_score
+        ties = np.bincount(sorted_group, weights=tied, minlength=len(topics)).astype(np.int64)
+
+        keys = sorted_group * max(len(doc_order), 1) + sorted_docs
+        _, first = np.unique(keys, return_index=True)
+        repeated = np.ones(len(order), dtype=bool)
+        repeated[first] = False
+        duplicates = {}
+        if np.any(repeated):
+            for topic_code, doc in sorted(set(zip(sorted_group[repeated].tolist(),
+                                                  sorted_docs[repeated].tolist()))):
+                duplicates.setdefault(topics[topic_code], []).append(self._tables['doc_id'][doc])
+        if deduplicate:
+            order = order[~repeated]
+
+        kept_group = group[order]
+        kept_sizes = np.bincount(kept_group, minlength=len(topics))
+        starts = np.concatenate(([0], np.cumsum(kept_sizes)[:-1])).astype(np.int64)
+        rank = np.arange(len(order)) - starts[kept_group] + 1
+        misranked = np.bincount(kept_group, weights=self._columns['rank'][order] != rank,
+                                minlength=len(topics)) > 0
+        truncated = {}
+        if depth is not None:
+            beyond = np.maximum(kept_sizes - depth, 0)
+            truncated = {topics[i]: int(beyond[i]) for i in np.flatnonzero(beyond)}
+            within = rank <= depth
+            order, rank = order[within], rank[within]
+
+        columns = {field: self._columns[field][order] for field in self._fields}
+        columns['rank'] = rank.astype(np.int32)
+        run_ids = [self._tables['run_id'][code]
+                   for code in np.unique(self._columns['run_id']).tolist()]
+        report = RunReport(
+            len(self), len(topics),
+            [topics[i] for i in np.flatnonzero(unsorted)],
+            [topics[i] for i in np.flatnonzero(misranked)],
+            {topics[i]: int(ties[i]) for i in np.flatnonzero(ties)},
+            duplicates, truncated, run_ids if len(run_ids) > 1 else [])
+        return self.from_columns(self._tables, columns), report
+
+    def validate(self) -> RunReport:
+        """
+        Check the runs for anomalies without changing them (see normalise).
+
+        :return: A RunReport
+        """
+        return self.normalise()[1]
 
     def dumps(self) -> str:
         """
@@ -89,35 +292,105 @@ class TrecEvalRuns(object):
         """
         return str(self)
 
-    def dump(self, fp: io.TextIOWrapper) -> None:
+    def dump(self, fp: io.TextIOWrapper, chunk_size: int = ITER_CHUNK_SIZE) -> None:
         """
-        Dump the qrels to a file
+        Dump the qrels to a file. Rows are formatted and written a chunk at a time, so the whole
+        file is never held in memory. Use dump_file to write a gzip file.
         
         :param fp: A File pointer
+        :param chunk_size: The number of rows formatted and written at a time
         """
-        fp.writelines(self.dumps())
+        self._write(fp, chunk_size)
 
 
-def loads(runs: str) -> TrecEvalRuns:
+@instrumented()
+def loads(runs: str, fast: bool = False) -> TrecEvalRuns:
     """
-    Load a trec_eval run file from a string.
+    Load a trec_eval run file from a string. The rows are grouped by topic: when the topics of
+    the lines are interleaved, the rows of each topic are moved together (topics keep the order
+    in which they first appear, and rows keep their order within a topic). Iterating over the
+    runs and dumping them then gives this grouped order rather than the order of the lines.
+
+    >>> loads('351 0 DOC1 1 100 run-name', fast=True).score
+    array([100.])
+    >>> loads('1 0 D1 1 3 r\\n2 0 D2 1 2 r\\n1 0 D3 2 1 r').doc_id
+    array(['D1', 'D3', 'D2'], dtype=object)
     
     :param runs: A string containing runs.
+    :param fast: Use the bulk tokenizer (see irkit.trec.columns.parse_bulk), which requires
+                 every line to have exactly six fields.
     :return: TrecEvalRuns
     """
-    data = []
-    for line in runs.split(os.linesep):
-        if len(line.split()) > 0:
-            topic, q, doc_id, rank, score, run_id = line.split()
-            data.append(TrecEvalRun(topic, q, doc_id, rank, score, run_id))
-    return TrecEvalRuns(data)
+    if fast:
+        return parse_bulk(TrecEvalRuns, [runs])
+    return ColumnBuilder(TrecEvalRuns).extend(split_lines(runs.split(os.linesep))).build()
 
 
-def load(runs: io.TextIOWrapper) -> TrecEvalRuns:
+@instrumented()
+def load(runs: io.TextIOWrapper, fast: bool = False) -> TrecEvalRuns:
     """
-    Load a trec_eval run file.
+    Load a trec_eval run file. As with loads, the rows are grouped by topic, so a file whose
+    topics are interleaved is not dumped back in the same order.
     
     :param runs: A file pointer containing runs.
+    :param fast: Use the bulk tokenizer (see irkit.trec.columns.parse_bulk), which requires
+                 every line to have exactly six fields. The file is tokenized in chunks of
+                 irkit.trec.columns.PARSE_CHUNK_SIZE characters.
+    :return: TrecEvalRuns
+    """
+    if fast:
+        return parse_bulk(TrecEvalRuns, read_chunks(runs))
+    return ColumnBuilder(TrecEvalRuns).extend(split_lines(runs)).build()
+
+
+@instrumented()
+def load_cached(path: str, cache_path: str = None) -> TrecEvalRuns:
+    """
+    Load a trec_eval run file through a binary cache. If the cache is at least as new as the file
+    it is memory-mapped, otherwise the file is parsed and the cache is written for next time.
+
+    :param path: Path of the text file
+    :param cache_path: Path of the binary cache (defaults to the path with the suffix
+                       irkit.trec.binary.CACHE_SUFFIX)
+    :return: TrecEvalRuns
+    """
+    return irkit.trec.binary.load_cached(TrecEvalRuns, path, load, cache_path)
+
+
+@instrumented()
+def load_shards(paths: Union[str, Sequence[str]], processes: int = None, fast: bool = False,
+                deduplicate: bool = True) -> TrecEvalRuns:
+    """
+    Load a trec_eval run file which is split into several shards (which may be gzip compressed),
+    parsing the shards in parallel worker processes and merging them (see irkit.trec.shards).
+
+    :param paths: A glob or path, or a list of them
+    :param processes: Number of worker processes (defaults to the number of CPUs)
+    :param fast: Parse the shards with the bulk tokenizer
+    :param deduplicate: Only keep the first row of each (topic, document) pair
     :return: TrecEvalRuns
     """
-    return loads(runs.read())
+    return irkit.trec.shards.load(TrecEvalRuns, paths, load, processes, fast, deduplicate)
+
+
+def iter_load(runs: io.TextIOWrapper, by_topic: bool = False) \
+        -> Iterator[Union[TrecEvalRun, TrecEvalRuns]]:
+    """
+    Lazily load a trec_eval run file, parsing one line at a time from the file pointer so that a
+    run can be processed in bounded memory.
+
+    >>> [str(run) for run in iter_load(io.StringIO('1 0 DOC1 1 2.5 r\\n2 0 DOC2 1 1 r'))]
+    ['1\\tQ0\\tDOC1\\t1\\t2.5\\tr', '2\\tQ0\\tDOC2\\t1\\t1\\tr']
+    >>> [runs.topics() for runs in iter_load(io.StringIO('1 0 D 1 2 r\\n2 0 D 1 1 r'), True)]
+    [['1'], ['2']]
+
+    :param runs: A file pointer containing runs.
+    :param by_topic: Yield a TrecEvalRuns for each topic instead of each TrecEvalRun. Only the
+                     lines of one topic are kept in memory, so the file should be sorted by topic.
+    :return: An iterator of TrecEvalRun or TrecEvalRuns
+    """
+    if by_topic:
+        yield from iter_groups(TrecEvalRuns, split_lines(runs))
+    else:
+        for topic, q, doc_id, rank, score, run_id in split_lines(runs):
+            yield TrecEvalRun(topic, q, doc_id, int(rank), float(score), run_id)
@@ -0,0 +1,127 @@
+"""
+Load a run or qrels file which is split into several shards (for instance one per topic range or
+per worker), any of which may be gzip compressed. The shards are parsed in parallel by a pool of
+worker processes and the parsed columns are merged: the string tables of the shards are unified
+(translating the codes of each shard once per distinct value), the columns are concatenated, and
+topics keep the order in which they first appear, taking the shards in order.
+
+Usage:
+
+>>> from irkit.trec import run
+>>> runs = run.load_shards('runs/part-*.run.gz')  # doctest: +SKIP
+"""
+import glob
+import gzip
+import multiprocessing
+
+import io
+import os
+from functools import partial
+from typing import Callable, List, Sequence, Union
+
+import numpy as np
+
+
+def expand(paths: Union[str, Sequence[str]]) -> List[str]:
+    """
+    Expand a glob, or a list of paths and globs, into the paths of the shards. The matches of
+    each glob are sorted; otherwise the order of the paths is kept.
+
+    :param paths: A glob or path, or a list of them
+    :return: The paths of the shards
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    expanded = []
+    for path in paths:
+        if glob.has_magic(path):
+            matches = sorted(glob.glob(path))
+            if not matches:
+                raise FileNotFoundError('No shards match {}'.format(path))
+            expanded.extend(matches)
+        else:
+            expanded.append(path)
+    return expanded
+
+
+def open_shard(path: str) -> io.TextIOWrapper:
+    """
+    Open a shard for reading, decompressing it if the path ends with .gz.
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt')
+    return open(path)
+
+
+def _load_shard(load: Callable, path: str, fast: bool = False):
+    with open_shard(path) as fp:
+        return load(fp, fast=fast)
+
+
+def merge(parts: Sequence, deduplicate: bool = True):
+    """
+    Merge Columns objects of the same type into one. Topics are ordered by their first
+    appearance, and the rows of a topic keep their order, taking the parts in order.
+
+    >>> from irkit.trec import run
+    >>> a = run.loads('1 0 D1 1 2 r\\n2 0 D1 1 1 r')
+    >>> b = run.loads('1 0 D2 2 1 r\\n1 0 D1 1 2 r\\n3 0 D3 1 1 r')
+    >>> merged = merge([a, b])
+    >>> merged.topics(), merged.doc_id.tolist()
+    (['1', '2', '3'], ['D1', 'D2', 'D1', 'D3'])
+
+    :param parts: Objects of one Columns class, such as TrecEvalRuns or Qrels
+    :param deduplicate: Only keep the first row of each (topic, document) pair
+    :return: A new object of the same class
+    """
+    columns_type = type(parts[0])
+    tables, columns = {}, {}
+    for field in columns_type._string_fields:
+        lookup = {}
+        codes = []
+        for part in parts:
+            translation = np.empty(len(part._tables[field]), dtype=np.int32)
+            for code, value in enumerate(part._tables[field]):
+                translation[code] = lookup.setdefault(value, len(lookup))
+            codes.append(translation[part._columns[field]])
+        tables[field] = list(lookup)
+        columns[field] = np.concatenate(codes)
+    for field in columns_type._numeric_fields:
+        columns[field] = np.concatenate([part._columns[field] for part in parts])
+
+    if deduplicate and len(columns[columns_type._topic_field]):
+        topics = columns[columns_type._topic_field].astype(np.int64)
+        documents = columns[columns_type._document_field]
+        keys = topics * max(len(tables[columns_type._document_field]), 1) + documents
+        _, first = np.unique(keys, return_index=True)
+        if len(first) < len(keys):
+            keep = np.sort(first)
+            columns = {field: column[keep] for field, column in columns.items()}
+    return columns_type.from_columns(tables, columns)
+
+
+def load(columns_type: type, paths: Union[str, Sequence[str]], load_text: Callable,
+         processes: int = None, fast: bool = False, deduplicate: bool = True):
+    """
+    Load shards in parallel and merge them.
+
+    :param columns_type: The Columns class to build
+    :param paths: A glob or path, or a list of them (see expand)
+    :param load_text: A picklable function which parses a file pointer into an object of
+                      columns_type, taking a fast keyword (such as irkit.trec.run.load)
+    :param processes: Number of worker processes (defaults to the number of CPUs)
+    :param fast: Parse the shards with the bulk tokenizer
+    :param deduplicate: Only keep the first row of each (topic, document) pair
+    :return: An object of columns_type
+    """
+    paths = expand(paths)
+    if not paths:
+        return columns_type()
+    work = partial(_load_shard, load_text, fast=fast)
+    processes = min(processes or os.cpu_count() or 1, len(paths))
+    if processes == 1:
+        parts = [work(path) for path in paths]
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            parts = pool.map(work, paths, chunksize=1)
+    return merge(parts, deduplicate)
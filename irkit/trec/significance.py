@@ -0,0 +1,292 @@
+"""
+Statistical significance tests between runs, over the per-query values of a measure. The
+randomisation and bootstrap tests draw all of their resamples as batched numpy matrix operations
+(a matrix of random sign flips or resample counts multiplied with the differences of every pair
+of runs at once), in chunks which keep memory bounded however many resamples are asked for.
+
+Usage:
+
+>>> from irkit.trec import results
+>>> a = results.loads('map 1 0.5\\nmap 2 0.4\\nmap 3 0.7\\nmap 4 0.2\\nmap 5 0.6')
+>>> b = results.loads('map 1 0.3\\nmap 2 0.35\\nmap 3 0.5\\nmap 4 0.1\\nmap 5 0.55')
+>>> c = results.loads('map 1 0.45\\nmap 2 0.5\\nmap 3 0.6\\nmap 4 0.25\\nmap 5 0.5')
+>>> for comparison in compare([a, b, c], 'map', test='t', correction='holm'):
+...     print(comparison.a, comparison.b, round(comparison.p_value, 4))
+0 1 0.024
+0 2 0.6483
+1 2 0.0612
+"""
+import math
+from collections import namedtuple
+
+import numpy as np
+from typing import List, Sequence, Tuple
+
+from irkit.trec.results import TrecEvalResults, aligned
+
+# The maximum number of elements of a matrix of resamples held in memory at once.
+CHUNK_ELEMENTS = 1 << 22
+
+# The result of comparing the runs at positions a and b: the mean difference of a and b over the
+# queries, the statistic of the test, and the p-value before and after correction.
+Comparison = namedtuple('Comparison', ['a', 'b', 'difference', 'statistic', 'p_value',
+                                       'corrected'])
+
+
+def _betainc(a: float, b: float, x: np.ndarray) -> np.ndarray:
+    """
+    The regularised incomplete beta function, evaluated with a continued fraction.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    # The continued fraction converges quickly below this point; above it, use the symmetry
+    # I_x(a, b) = 1 - I_{1-x}(b, a).
+    swap = x > (a + 1) / (a + b + 2)
+    out = np.empty_like(x)
+    out[~swap] = _betainc_fraction(a, b, x[~swap])
+    out[swap] = 1 - _betainc_fraction(b, a, 1 - x[swap])
+    return out
+
+
+def _betainc_fraction(a: float, b: float, x: np.ndarray) -> np.ndarray:
+    tiny = 1e-300
+    with np.errstate(divide='ignore'):
+        front = np.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b)
+                       + a * np.log(x) + b * np.log1p(-x)) / a
+    c = np.ones_like(x)
+    d = 1 - (a + b) * x / (a + 1)
+    d = 1 / np.where(np.abs(d) < tiny, tiny, d)
+    f = d.copy()
+    for m in range(1, 300):
+        for numerator in (m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)),
+                          -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1))):
+            d = 1 + numerator * d
+            d = 1 / np.where(np.abs(d) < tiny, tiny, d)
+            c = 1 + numerator / c
+            c = np.where(np.abs(c) < tiny, tiny, c)
+            delta = c * d
+            f *= delta
+        if np.all(np.abs(delta - 1) < 1e-15):
+            break
+    return np.where(x <= 0, 0.0, np.where(x >= 1, 1.0, front * f))
+
+
+def _t_p_values(t: np.ndarray, df: int) -> np.ndarray:
+    """
+    Two sided p-values of Student's t distribution.
+    """
+    t = np.asarray(t, dtype=np.float64)
+    if df < 1:
+        return np.full(t.shape, np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = np.where(np.isinf(t), 0.0, df / (df + t * t))
+    return np.where(np.isnan(t), np.nan, _betainc(df / 2, 0.5, x))
+
+
+def _t_test(differences: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    n = differences.shape[-1]
+    mean = differences.mean(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        error = differences.std(axis=-1, ddof=1) / math.sqrt(n)
+        t = np.where(error > 0, mean / error, np.where(mean == 0, np.nan, np.sign(mean) * np.inf))
+    return t, _t_p_values(t, n - 1)
+
+
+def _ranks(values: np.ndarray) -> np.ndarray:
+    """
+    Rank values from 1, giving tied values the average of their ranks.
+    """
+    unique, inverse, counts = np.unique(values, return_inverse=True, return_counts=True)
+    ends = np.cumsum(counts)
+    return ((ends - (counts - 1) / 2)[inverse]).astype(np.float64)
+
+
+def _wilcoxon(differences: np.ndarray) -> Tuple[float, float]:
+    differences = differences[differences != 0]
+    n = len(differences)
+    if n == 0:
+        return 0.0, 1.0
+    ranks = _ranks(np.abs(differences))
+    positive = ranks[differences > 0].sum()
+    statistic = min(positive, n * (n + 1) / 2 - positive)
+    _, counts = np.unique(ranks, return_counts=True)
+    variance = n * (n + 1) * (2 * n + 1) / 24 - np.sum(counts ** 3 - counts) / 48
+    if variance <= 0:
+        return statistic, 1.0
+    z = (positive - n * (n + 1) / 4) / math.sqrt(variance)
+    return statistic, math.erfc(abs(z) / math.sqrt(2))
+
+
+def _chunks(total: int, n: int) -> List[int]:
+    """
+    Split a number of resamples into chunks of at most CHUNK_ELEMENTS elements.
+    """
+    size = max(1, CHUNK_ELEMENTS // max(n, 1))
+    return [min(size, total - start) for start in range(0, total, size)]
+
+
+def _randomisation_test(differences: np.ndarray, permutations: int,
+                        rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray]:
+    # Under the null hypothesis the two values of a query are exchangeable, so flipping the sign
+    # of its difference is equally likely. Each row of a sign matrix is one permutation, and
+    # multiplying it with the differences gives the (scaled) mean of every pair at once.
+    n = differences.shape[-1]
+    observed = np.abs(differences.sum(axis=-1))
+    extreme = np.zeros(differences.shape[0], dtype=np.int64)
+    for size in _chunks(permutations, n):
+        signs = rng.integers(0, 2, size=(size, n), dtype=np.int8) * 2 - 1
+        sums = np.abs(signs.astype(np.float64) @ differences.T)
+        extreme += np.count_nonzero(sums >= observed - 1e-12, axis=0)
+    return differences.mean(axis=-1), (extreme + 1) / (permutations + 1)
+
+
+def _bootstrap_test(differences: np.ndarray, samples: int,
+                    rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray]:
+    # Resampling queries with replacement is drawing how many times each query is picked; the
+    # differences are shifted to a mean of zero so the resamples follow the null hypothesis.
+    n = differences.shape[-1]
+    mean = differences.mean(axis=-1)
+    shifted = differences - mean[:, np.newaxis]
+    observed = np.abs(mean)
+    extreme = np.zeros(differences.shape[0], dtype=np.int64)
+    for size in _chunks(samples, n):
+        counts = rng.multinomial(n, np.full(n, 1 / n), size=size).astype(np.float64)
+        means = np.abs(counts @ shifted.T) / n
+        extreme += np.count_nonzero(means >= observed - 1e-12, axis=0)
+    return mean, (extreme + 1) / (samples + 1)
+
+
+def _differences(a: Sequence[float], b: Sequence[float]) -> np.ndarray:
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    if a.shape != b.shape or a.ndim != 1:
+        raise ValueError('Expected two sequences of paired values of the same length')
+    return (a - b)[np.newaxis]
+
+
+def t_test(a: Sequence[float], b: Sequence[float]) -> Tuple[float, float]:
+    """
+    Paired, two sided Student's t-test.
+
+    :param a: The values of a measure for each query of one run
+    :param b: The values for the same queries of another run
+    :return: The t statistic and the p-value
+    """
+    t, p = _t_test(_differences(a, b))
+    return float(t[0]), float(p[0])
+
+
+def wilcoxon(a: Sequence[float], b: Sequence[float]) -> Tuple[float, float]:
+    """
+    Two sided Wilcoxon signed-rank test, using the normal approximation (with a correction for
+    ties). Queries where the values are equal are left out.
+
+    :param a: The values of a measure for each query of one run
+    :param b: The values for the same queries of another run
+    :return: The smaller of the positive and negative rank sums, and the p-value
+    """
+    statistic, p = _wilcoxon(_differences(a, b)[0])
+    return float(statistic), float(p)
+
+
+def randomisation_test(a: Sequence[float], b: Sequence[float], permutations: int = 10000,
+                       seed: int = None) -> Tuple[float, float]:
+    """
+    Two sided paired randomisation (permutation) test of the mean difference, with random sign
+    flips of the differences.
+
+    :param a: The values of a measure for each query of one run
+    :param b: The values for the same queries of another run
+    :param permutations: The number of random permutations
+    :param seed: Seed of the random number generator
+    :return: The mean difference and the p-value
+    """
+    mean, p = _randomisation_test(_differences(a, b), permutations, np.random.default_rng(seed))
+    return float(mean[0]), float(p[0])
+
+
+def bootstrap_test(a: Sequence[float], b: Sequence[float], samples: int = 10000,
+                   seed: int = None) -> Tuple[float, float]:
+    """
+    Two sided paired bootstrap test of the mean difference.
+
+    :param a: The values of a measure for each query of one run
+    :param b: The values for the same queries of another run
+    :param samples: The number of bootstrap resamples
+    :param seed: Seed of the random number generator
+    :return: The mean difference and the p-value
+    """
+    mean, p = _bootstrap_test(_differences(a, b), samples, np.random.default_rng(seed))
+    return float(mean[0]), float(p[0])
+
+
+def correct(p_values: Sequence[float], method: str = 'holm') -> np.ndarray:
+    """
+    Correct p-values for multiple comparisons.
+
+    >>> correct([0.01, 0.04, 0.03], 'bonferroni')
+    array([0.03, 0.12, 0.09])
+    >>> correct([0.01, 0.04, 0.03], 'holm')
+    array([0.03, 0.06, 0.06])
+    >>> correct([0.01, 0.04, 0.03], 'bh')
+    array([0.03, 0.04, 0.04])
+
+    :param p_values: The p-values of each comparison
+    :param method: bonferroni, holm (Holm-Bonferroni) or bh (Benjamini-Hochberg), or None
+    :return: The corrected p-values, in the same order
+    """
+    p_values = np.asarray(p_values, dtype=np.float64)
+    n = len(p_values)
+    if method is None or n == 0:
+        return p_values.copy()
+    if method == 'bonferroni':
+        return np.minimum(p_values * n, 1)
+    order = np.argsort(p_values, kind='stable')
+    ordered = p_values[order]
+    if method == 'holm':
+        ordered = np.maximum.accumulate(ordered * (n - np.arange(n)))
+    elif method == 'bh':
+        ordered = np.minimum.accumulate((ordered * n / np.arange(1, n + 1))[::-1])[::-1]
+    else:
+        raise ValueError('Unknown correction {}'.format(method))
+    corrected = np.empty(n)
+    corrected[order] = np.minimum(ordered, 1)
+    return corrected
+
+
+def compare(results: Sequence[TrecEvalResults], measure: str, test: str = 't',
+            correction: str = 'holm', permutations: int = 10000, samples: int = 10000,
+            seed: int = None) -> List[Comparison]:
+    """
+    Compare every pair of runs with a significance test, over the queries all of the runs have
+    values for, and correct the p-values for the number of comparisons. The randomisation and
+    bootstrap tests share each batch of resamples between all of the pairs.
+
+    :param results: The results of each run
+    :param measure: The name of the measure to compare, e.g. map
+    :param test: t, wilcoxon, randomisation or bootstrap
+    :param correction: bonferroni, holm, bh, or None for no correction
+    :param permutations: The number of permutations of the randomisation test
+    :param samples: The number of resamples of the bootstrap test
+    :param seed: Seed of the random number generator
+    :return: A Comparison for each pair (a, b) with a < b, in order
+    """
+    _, values = aligned(results, measure)
+    a, b = np.triu_indices(len(results), k=1)
+    if len(a) == 0:
+        return []
+    differences = values[a] - values[b]
+    if test == 't':
+        statistics, p_values = _t_test(differences)
+    elif test == 'wilcoxon':
+        statistics, p_values = np.array([_wilcoxon(row) for row in differences]).T
+    elif test == 'randomisation':
+        statistics, p_values = _randomisation_test(differences, permutations,
+                                                   np.random.default_rng(seed))
+    elif test == 'bootstrap':
+        statistics, p_values = _bootstrap_test(differences, samples, np.random.default_rng(seed))
+    else:
+        raise ValueError('Unknown test {}'.format(test))
+    corrected = correct(p_values, correction)
+    means = differences.mean(axis=-1) if differences.shape[-1] else np.full(len(a), np.nan)
+    return [Comparison(int(i), int(j), float(mean), float(statistic), float(p), float(q))
+            for i, j, mean, statistic, p, q in zip(a, b, means, statistics, p_values, corrected)]
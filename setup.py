@@ -104,7 +104,8 @@ setup(
     # pip to create the appropriate form of executable for the target platform.
     entry_points={
         'console_scripts': [
-            'trecplot=plot:main',
+            'trecplot=irkit.plot:main',
+            'trecbatch=irkit.trec.batch:main',
         ],
     },
 )